@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+
+import notify
+
+
+def load_fixtures(fixture_dir):
+    """按页面类型读取保存的HTML页面"""
+    fixtures = {}
+    for page_type in notify.EXTRACTORS:
+        page_dir = os.path.join(fixture_dir, page_type)
+        if not os.path.isdir(page_dir):
+            continue
+        pages = []
+        for name in sorted(os.listdir(page_dir)):
+            with open(os.path.join(page_dir, name), encoding="utf-8") as f:
+                pages.append(f.read())
+        if pages:
+            fixtures[page_type] = pages
+    return fixtures
+
+
+def benchmark(page_type, pages, rounds):
+    """解析同一类页面 rounds 次，返回 (条目数, 耗时秒)"""
+    extractor = notify.EXTRACTORS[page_type]
+    items = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for page in pages:
+            items += len(extractor(page))
+    return items, time.perf_counter() - start
+
+
+def main():
+    fixture_dir = sys.argv[1] if len(sys.argv) > 1 else notify.TEST_FIXTURE_DIR
+    rounds = int(os.getenv("BENCH_ROUNDS", "20"))
+    fixtures = load_fixtures(fixture_dir)
+    if not fixtures:
+        print(
+            f"{fixture_dir} 中没有页面，请先设置 BB_CAPTURE_FIXTURES=1 运行一次 notify.py"
+        )
+        return
+
+    print(f"{'page type':<20}{'pages':>8}{'items':>10}{'pages/s':>12}{'items/s':>12}")
+    for page_type, pages in fixtures.items():
+        items, seconds = benchmark(page_type, pages, rounds)
+        print(
+            f"{page_type:<20}{len(pages):>8}{items // rounds:>10}"
+            f"{len(pages) * rounds / seconds:>12.1f}{items / seconds:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,38 @@
+import hashlib
+import heapq
+import io
+import json
 import os
 import pickle
+import queue
+import random
 import smtplib
 import sqlite3
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from itertools import groupby
 
 import pytz
 import requests
 import urllib3.contrib.pyopenssl
 from lxml import etree
 from requests import Session
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 from typing import cast
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, runs are not locked there
+    fcntl = None
+
 """
 This is an auto script for CUHKSZ Blackboard.
 """
@@ -32,34 +50,275 @@ class ValidationError(Exception):
         return self.message
 
 
+SESSION_PATH = "./persist/session.pkl"
+
+
+class RateLimiter:
+    """
+    Token bucket with an AIMD concurrency window.
+    The bucket caps the request rate, the window grows by one request per healthy
+    round trip and halves when the server answers slowly, with 429 or with 5xx.
+    """
+
+    def __init__(
+        self, rate=None, burst=None, max_concurrency=None, latency_target=None
+    ):
+        self.rate = rate or float(os.getenv("BB_RATE_LIMIT", "10"))
+        self.burst = burst or int(os.getenv("BB_RATE_BURST", "10"))
+        self.max_concurrency = max_concurrency or int(
+            os.getenv("BB_MAX_CONCURRENCY", "8")
+        )
+        self.latency_target = latency_target or float(
+            os.getenv("BB_LATENCY_TARGET", "3")
+        )
+        self._reset()
+
+    def _reset(self):
+        self.cond = threading.Condition()
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.throttled = 0
+
+    def __getstate__(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "max_concurrency": self.max_concurrency,
+            "latency_target": self.latency_target,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+                self.cond.wait(delay)
+
+    def release(self, latency: float, healthy: bool):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if healthy and latency <= self.latency_target:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            elif now - self.last_decrease > latency:
+                # Decrease at most once per round trip, requests already in flight
+                # saw the same overload and should not halve the window again
+                self.limit = max(1.0, self.limit / 2)
+                self.last_decrease = now
+            self.cond.notify_all()
+
+    def pause(self, seconds: float):
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.throttled += 1
+
+
+class Transport:
+    """
+    Keep-alive HTTP transport shared by every request of a Login.
+    Connections are pooled per host, so a crawl pays the TCP+TLS handshake once per
+    pooled connection instead of once per request. Requests are paced by a
+    RateLimiter and retried with exponential backoff on 429, 5xx and network errors.
+    """
+
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=None, timeout=None, limiter: RateLimiter = None):
+        self.pool_size = pool_size or int(os.getenv("BB_POOL_SIZE", "10"))
+        self.timeout = timeout or float(os.getenv("BB_TIMEOUT", "30"))
+        self.max_retries = int(os.getenv("BB_MAX_RETRIES", "3"))
+        self.limiter = limiter or RateLimiter()
+        self.retries = 0
+        # pool_block bounds the number of open connections per host
+        self.adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=self.pool_size, pool_block=True
+        )
+
+    def mount(self, _session: Session) -> Session:
+        _session.mount("https://", self.adapter)
+        _session.mount("http://", self.adapter)
+        return _session
+
+    def request(self, _session: Session, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        # POST is not idempotent, only the login form uses it
+        max_retries = self.max_retries if method == "GET" else 0
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                r = _session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.limiter.release(time.monotonic() - start, healthy=False)
+                if attempt >= max_retries:
+                    raise
+                r = None
+            else:
+                healthy = r.status_code not in self.retry_status
+                self.limiter.release(time.monotonic() - start, healthy=healthy)
+                if healthy or attempt >= max_retries:
+                    return r
+            delay = min(60.0, 2**attempt) * (0.5 + random.random())
+            if r is not None and r.headers.get("Retry-After", "").isdigit():
+                delay = max(delay, float(r.headers["Retry-After"]))
+            if r is not None and r.status_code == 429:
+                self.limiter.pause(delay)
+            attempt += 1
+            self.retries += 1
+            time.sleep(delay)
+
+    def stats(self) -> dict:
+        pools = self.adapter.poolmanager.pools
+        num_requests = 0
+        num_connections = 0
+        for key in pools.keys():
+            pool = pools[key]
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        return {
+            "requests": num_requests,
+            "connections": num_connections,
+            "handshakes_avoided": num_requests - num_connections,
+            "retries": self.retries,
+            "throttled": self.limiter.throttled,
+            "concurrency": int(self.limiter.limit),
+        }
+
+
 class Login:
     _session: Session
+    transport: Transport
+    session_path = SESSION_PATH
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
         "Chrome/79.0.3945.88 Safari/537.36",
-        "Connection": "close",
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
     }
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, transport: Transport = None):
+        self.username = username
+        self.password = password
+        self.transport = transport or Transport()
         self._session = self.login(username, password)
 
+    def ensure_session(self) -> None:
+        """
+        Log in again if the session expired, a long running process calls this
+        before every cycle
+        """
+        if not self.is_session_valid(self._session):
+            print("Session expired, logging in again...")
+            self._session = self.login(self.username, self.password)
+
     def get_session(self) -> Session:
         return self._session
 
     def login(self, username, password) -> Session:
         pass
 
-    def get(self, url, **kwargs):
-        return self._session.get(url, headers=self.headers, **kwargs)
+    def is_session_valid(self, _session: Session) -> bool:
+        return False
+
+    def save_session(self, _session: Session, username) -> None:
+        """
+        Persist the cookie jar so the next run can skip the login handshake.
+        The file is created with 0600 permissions since it grants account access.
+        """
+        os.makedirs(os.path.dirname(self.session_path), exist_ok=True)
+        data = pickle.dumps({"username": username, "cookies": _session.cookies})
+        fd = os.open(self.session_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(self.session_path, 0o600)
+
+    def restore_session(self, username) -> Session | None:
+        """
+        Load the persisted cookie jar and return a session if it is still valid.
+        :return: None if there is no usable session and a fresh login is required
+        """
+        if not os.path.exists(self.session_path):
+            return None
+        try:
+            with open(self.session_path, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            print(f"Failed to load saved session: {e}")
+            return None
+        if data.get("username") != username:
+            return None
+        _session = self.transport.mount(requests.Session())
+        _session.cookies.update(data["cookies"])
+        if not self.is_session_valid(_session):
+            return None
+        return _session
+
+    def get(self, url, headers=None, **kwargs):
+        headers = {**self.headers, **(headers or {})}
+        r = self.transport.request(self._session, "GET", url, headers=headers, **kwargs)
+        if CAPTURE_FIXTURES:
+            save_fixture(url, r.text)
+        return r
 
     def post(self, url, **kwargs):
-        return self._session.post(url, headers=self.headers, **kwargs)
+        return self.transport.request(
+            self._session, "POST", url, headers=self.headers, **kwargs
+        )
+
+    def stats(self) -> str:
+        _stats = self.transport.stats()
+        return (
+            f"{_stats['requests']} requests over {_stats['connections']} connections, "
+            f"{_stats['handshakes_avoided']} handshakes avoided, "
+            f"{_stats['retries']} retries, {_stats['throttled']} throttled, "
+            f"concurrency window {_stats['concurrency']}"
+        )
 
 
 class BBLogin(Login):
+    # Small authenticated endpoint, redirects to the login page when the session expired
+    probe_url = "https://bb.cuhk.edu.cn/webapps/calendar/calendarFeed/url"
+
+    def is_session_valid(self, _session: Session) -> bool:
+        try:
+            r = self.transport.request(
+                _session,
+                "GET",
+                self.probe_url,
+                headers=self.headers,
+                allow_redirects=False,
+                timeout=10,
+            )
+        except requests.RequestException:
+            return False
+        return r.status_code == 200 and "login" not in r.text[:200].lower()
+
     def login(self, username, password) -> Session:
         urllib3.contrib.pyopenssl.inject_into_urllib3()
-        _session = requests.Session()
+        _session = self.restore_session(username)
+        if _session is not None:
+            print("Session restored!")
+            return _session
+        _session = self.transport.mount(requests.Session())
 
         def stage1(_session: Session):
             response_type = "code"
@@ -79,7 +338,9 @@ class BBLogin(Login):
                 "AuthMethod": "FormsAuthentication",
             }
             url = "https://sts.cuhk.edu.cn/adfs/oauth2/authorize"
-            r = _session.post(
+            r = self.transport.request(
+                _session,
+                "POST",
                 url,
                 headers=self.headers,
                 params=params,
@@ -92,6 +353,7 @@ class BBLogin(Login):
 
         stage1(_session)
         print("Login successfully!")
+        self.save_session(_session, username)
         return _session
 
 
@@ -100,28 +362,387 @@ database.py below
 """
 
 
+class EventUnpickler(pickle.Unpickler):
+    """
+    Rows written by earlier `python notify.py` runs name their classes after
+    __main__, load them from this module
+    """
+
+    def find_class(self, module, name):
+        if module == "__main__":
+            module = __name__
+        return super().find_class(module, name)
+
+
+def load_event(data: bytes):
+    return EventUnpickler(io.BytesIO(data)).load()
+
+
+class ConnectionManager:
+    """
+    One sqlite3 connection per thread, all opened in WAL mode so readers on worker
+    threads do not block on the writer. Statements are cached per connection by
+    sqlite3, the SQL strings used by Database are constant so they are reused.
+    Worker pools start new threads every cycle, the connections of finished
+    threads are closed by prune.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.cache_size_mb = int(os.getenv("BB_DB_CACHE_MB", "16"))
+        self.mmap_size_mb = int(os.getenv("BB_DB_MMAP_MB", "64"))
+        self.local = threading.local()
+        self.connections: dict[threading.Thread, sqlite3.Connection] = {}
+        self.lock = threading.Lock()
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            self.prune()
+            os.makedirs(os.path.dirname(self.db_name) or ".", exist_ok=True)
+            conn = sqlite3.connect(
+                self.db_name, timeout=30, cached_statements=256, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA busy_timeout = 30000")
+            conn.execute(f"PRAGMA cache_size = -{self.cache_size_mb * 1024}")
+            conn.execute(f"PRAGMA mmap_size = {self.mmap_size_mb * 1024 * 1024}")
+            self.local.conn = conn
+            with self.lock:
+                self.connections[threading.current_thread()] = conn
+        return conn
+
+    def prune(self):
+        """
+        Close the connections of threads that have finished
+        """
+        with self.lock:
+            for thread in [t for t in self.connections if not t.is_alive()]:
+                self.connections.pop(thread).close()
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+
 class Database:
+    schema_version = 1
+    # Typed columns kept next to the pickled object, keyword filters on these run in SQL
+    columns = (
+        "course_id",
+        "parent_id",
+        "title",
+        "path",
+        "due",
+        "is_finished",
+        "detail_hash",
+    )
+
     def __init__(self, db_name):
         self.db_name = db_name
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-        self.initialize_database()
+        self.connections = ConnectionManager(db_name)
+        # Reads run on per-thread connections, writes and the unit of work state
+        # go through lock so there is a single writer
+        self.lock = threading.RLock()
+        self.pending_backfill = False
+        # Unit of work: events saved inside Database.unit_of_work are kept here
+        # and written in one transaction by flush, together with pending_writes.
+        # Both carry a sequence number so flush applies them in the order they
+        # were made, an event saved several times takes the number of its last save
+        self.dirty: dict[tuple[str, str], tuple[int, object]] | None = None
+        self.pending_writes: list[tuple[int, str, tuple]] = []
+        # State values written in the unit of work, as JSON, for get_state
+        self.pending_state: dict[str, str] = {}
+        # Events and courses deleted in the unit of work. Reads merge these and
+        # dirty into the stored rows, so they do not have to flush.
+        self.deleted: set[tuple[str, str]] = set()
+        self.deleted_courses: set[str] = set()
+        self.write_seq = 0
+        self.uow_depth = 0
+        self.flush_every = int(os.getenv("BB_DB_FLUSH_EVERY", "500"))
+        self.commit_count = 0
+        # The file is opened and migrated on first use, importing notify does not
+        # touch the disk
+        self.initialized = False
+        self.upsert_sql = (
+            "INSERT INTO events (id_str, event_type, "
+            + ", ".join(self.columns)
+            + ", first_seen, last_seen, obj) VALUES ("
+            + ", ".join("?" * (len(self.columns) + 5))
+            + ") ON CONFLICT (id_str, event_type) DO UPDATE SET "
+            + ", ".join(f"{column} = excluded.{column}" for column in self.columns)
+            + ", last_seen = excluded.last_seen, obj = excluded.obj"
+        )
 
-    def initialize_database(self):
-        self.cursor.execute(
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = self.connections.get()
+        if not self.initialized:
+            with self.lock:
+                if not self.initialized:
+                    self.initialized = True
+                    try:
+                        self.initialize_database(conn)
+                    except Exception:
+                        self.initialized = False
+                        raise
+                    if self.pending_backfill:
+                        self._backfill()
+        return conn
+
+    def initialize_database(self, conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        legacy = (
+            version < 1
+            and cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'events'"
+            ).fetchone()
+        )
+        if legacy:
+            cursor.execute("ALTER TABLE events RENAME TO events_legacy")
+        cursor.execute(
             """CREATE TABLE IF NOT EXISTS events
-                               (id TEXT, obj BLOB, id_str TEXT, event_type TEXT,
+                               (id_str TEXT NOT NULL, event_type TEXT NOT NULL,
+                               course_id TEXT, parent_id TEXT, title TEXT,
+                               path TEXT, due REAL,
+                               is_finished INTEGER, detail_hash TEXT,
+                               first_seen REAL, last_seen REAL, obj BLOB,
                                PRIMARY KEY (id_str, event_type))"""
         )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_course ON events (event_type, course_id)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_parent ON events (event_type, parent_id)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_due ON events (event_type, due)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_title ON events (event_type, title)"
+        )
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        # See PageCache
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS pages
+                               (url TEXT PRIMARY KEY, hash TEXT, etag TEXT,
+                               last_modified TEXT, children TEXT)"""
+        )
+        if legacy:
+            # Rows are copied as they are, columns are filled by _backfill once
+            # the connection is ready
+            now = time.time()
+            cursor.execute(
+                "INSERT INTO events (id_str, event_type, first_seen, last_seen, obj) "
+                "SELECT id_str, event_type, ?, ?, obj FROM events_legacy",
+                (now, now),
+            )
+            cursor.execute("DROP TABLE events_legacy")
+            self.pending_backfill = True
+        cursor.execute(f"PRAGMA user_version = {self.schema_version}")
+        conn.commit()
+
+    def _backfill(self):
+        """
+        Fill the columns of migrated rows and pickle them again with their own
+        fields only.
+        """
+        self.pending_backfill = False
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id_str, event_type, obj FROM events")
+        _events = [
+            (id_str, event_type, load_event(obj))
+            for id_str, event_type, obj in cursor.fetchall()
+        ]
+        # Old rows have no parent_id, recover it from the pickled folder contents
+        parents = {}
+        for _, _, _event in _events:
+            for __child in _event.__dict__.get("contents", []):
+                parents[__child.id] = _event.id
+        for id_str, event_type, _event in _events:
+            if hasattr(_event, "parent_id") and _event.parent_id is None:
+                _event.parent_id = parents.get(_event.id)
+            columns = _event.columns()
+            cursor.execute(
+                "UPDATE events SET "
+                + ", ".join(f"{column} = ?" for column in self.columns)
+                + ", obj = ? WHERE id_str = ? AND event_type = ?",
+                (
+                    *[columns[column] for column in self.columns],
+                    pickle.dumps(_event),
+                    id_str,
+                    event_type,
+                ),
+            )
         self.conn.commit()
+        cursor.execute("VACUUM")
 
-    def add_event(self, _event):
-        obj_data = pickle.dumps(_event)
-        self.cursor.execute(
-            "INSERT OR REPLACE INTO events (obj, id_str, event_type) VALUES (?, ?, ?)",
-            (obj_data, _event.id, _event.__class__.__name__),
+    def execute_write(self, query, params=()):
+        """
+        Run a write statement now, or leave it to the flush of the current unit of
+        work so the whole crawl is written from a single connection.
+        """
+        with self.lock:
+            if self.dirty is not None:
+                self.write_seq += 1
+                self.pending_writes.append((self.write_seq, query, params))
+                return
+            conn = self.conn
+            conn.execute(query, params)
+            conn.commit()
+            self.commit_count += 1
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Collect every save inside the block and write them in a single transaction,
+        or every flush_every events. An event saved several times is written once.
+        """
+        with self.lock:
+            self.uow_depth += 1
+            if self.dirty is None:
+                self.dirty = {}
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.uow_depth -= 1
+                if self.uow_depth == 0:
+                    try:
+                        self.flush()
+                    finally:
+                        self.dirty = None
+
+    def flush(self):
+        """
+        Write the saved events and the pending writes in the order they were made,
+        consecutive statements of the same kind in one executemany. If the
+        transaction fails it is rolled back and the buffered writes are dropped.
+        """
+        with self.lock:
+            conn = self.conn
+            now = time.time()
+            writes = [
+                (seq, self.upsert_sql, self._row(_event, now))
+                for seq, _event in (self.dirty or {}).values()
+            ]
+            writes.extend(self.pending_writes)
+            writes.sort(key=lambda write: write[0])
+            try:
+                for query, group in groupby(writes, key=lambda write: write[1]):
+                    conn.executemany(query, [params for _, _, params in group])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                if self.dirty:
+                    self.dirty.clear()
+                self.pending_writes.clear()
+                self.pending_state.clear()
+                self.deleted.clear()
+                self.deleted_courses.clear()
+            self.commit_count += 1
+
+    def _row(self, _event, now) -> tuple:
+        columns = _event.columns()
+        return (
+            _event.id,
+            _event.__class__.__name__,
+            *[columns[column] for column in self.columns],
+            now,
+            now,
+            pickle.dumps(_event),
         )
-        self.conn.commit()
+
+    @staticmethod
+    def fingerprint(columns: dict) -> str:
+        return hashlib.sha1(json.dumps(columns, sort_keys=True).encode()).hexdigest()
+
+    def fingerprints(self, event_type) -> dict[str, str]:
+        """
+        id -> fingerprint of every stored event of a type, computed from the indexed
+        columns without unpickling any object
+        """
+        query = (
+            f"SELECT id_str, course_id, {', '.join(self.columns)} FROM events "
+            "WHERE event_type = ?"
+        )
+        rows, saved = self._merged(event_type, query, (event_type,))
+        fingerprints = {
+            row[0]: self.fingerprint(dict(zip(self.columns, row[2:]))) for row in rows
+        }
+        for _event in saved:
+            columns = _event.columns()
+            fingerprints[_event.id] = self.fingerprint(
+                {column: columns[column] for column in self.columns}
+            )
+        return fingerprints
+
+    def count_events(self, *event_types: str) -> int:
+        """
+        Number of stored events of the types, without loading them
+        """
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM events WHERE event_type IN ("
+            + ", ".join("?" * len(event_types))
+            + ")",
+            event_types,
+        ).fetchone()[0]
+
+    def _merged(self, event_type, query, params, _id=None) -> tuple[list, list]:
+        """
+        Read rows of event_type with the unit of work merged in, instead of
+        flushing it. The query selects id_str and course_id first.
+        :param _id: the id the query is restricted to
+        :return: the rows that were neither saved again nor deleted in the unit of
+            work, and the events of event_type saved in it
+        """
+        with self.lock:
+            if self.dirty is not None:
+                rows = self.conn.execute(query, params).fetchall()
+                if _id is None:
+                    saved = {
+                        key[1]: _event
+                        for key, (_, _event) in self.dirty.items()
+                        if key[0] == event_type
+                    }
+                elif (event_type, _id) in self.dirty:
+                    saved = {_id: self.dirty[(event_type, _id)][1]}
+                else:
+                    saved = {}
+                rows = [
+                    row
+                    for row in rows
+                    if row[0] not in saved
+                    and (event_type, row[0]) not in self.deleted
+                    and row[1] not in self.deleted_courses
+                    and not (
+                        event_type == "CourseEvent" and row[0] in self.deleted_courses
+                    )
+                ]
+                return rows, list(saved.values())
+        return self.conn.execute(query, params).fetchall(), []
+
+    def add_event(self, _event):
+        with self.lock:
+            if self.dirty is not None:
+                self.write_seq += 1
+                self.dirty[(_event.__class__.__name__, _event.id)] = (
+                    self.write_seq,
+                    _event,
+                )
+                if len(self.dirty) >= self.flush_every:
+                    self.flush()
+                return
+        self.execute_write(self.upsert_sql, self._row(_event, time.time()))
 
     def get_event(self, event_type, **kwargs) -> object:
         _all = self.filter_events(event_type, **kwargs)
@@ -130,17 +751,30 @@ class Database:
         raise ValueError(f"No {event_type} found with {kwargs}")
 
     def filter_events(self, event_type, id=None, **kwargs) -> list[object]:
+        query = "SELECT id_str, course_id, obj FROM events WHERE event_type = ?"
+        params = [event_type]
         if id:
-            query = "SELECT obj FROM events WHERE event_type = ? AND id_str = ?"
-            self.cursor.execute(query, (event_type, id))
-
-        else:
-            query = "SELECT obj FROM events WHERE event_type = ?"
-            self.cursor.execute(query, (event_type,))
-        results = self.cursor.fetchall()
+            query += " AND id_str = ?"
+            params.append(id)
+        column_filters = {}
+        for key in [key for key in kwargs if key in self.columns]:
+            value = kwargs.pop(key)
+            if isinstance(value, datetime):
+                value = value.timestamp()
+            query += f" AND {key} IS ?"
+            params.append(value)
+            column_filters[key] = value
+        rows, saved = self._merged(event_type, query, params, id or None)
+        results = [row[2] for row in rows]
+        # Read your own writes, copied like the stored ones
+        with self.lock:
+            for _event in saved:
+                columns = _event.columns()
+                if all(columns[key] == value for key, value in column_filters.items()):
+                    results.append(pickle.dumps(_event))
         _all = []
         for obj in results:
-            _event = pickle.loads(obj[0])
+            _event = load_event(obj)
             if all(
                 getattr(_event, key, None) == value for key, value in kwargs.items()
             ):
@@ -148,17 +782,359 @@ class Database:
         return _all
 
     def delete_event(self, event_type, id, **kwargs):
-        self.cursor.execute(
-            "DELETE FROM events WHERE event_type = ? AND id_str = ?",
+        with self.lock:
+            if self.dirty is not None:
+                self.dirty.pop((event_type, id), None)
+                self.deleted.add((event_type, id))
+            self.execute_write(
+                "DELETE FROM events WHERE event_type = ? AND id_str = ?",
+                (
+                    event_type,
+                    id,
+                ),
+            )
+
+    def delete_course(self, course_id):
+        """
+        Delete a course together with every event that belongs to it
+        """
+        with self.lock:
+            if self.dirty is not None:
+                for key, (_, _event) in list(self.dirty.items()):
+                    if key == ("CourseEvent", course_id) or (
+                        _event.columns()["course_id"] == course_id
+                    ):
+                        del self.dirty[key]
+                self.deleted_courses.add(course_id)
+            self.execute_write(
+                "DELETE FROM events WHERE course_id = ? "
+                "OR (event_type = 'CourseEvent' AND id_str = ?)",
+                (course_id, course_id),
+            )
+
+    def ids_in_range(self, event_type, column, low, high) -> list[str]:
+        """
+        Ids of the events whose indexed column lies in [low, high]
+        """
+        if column not in self.columns:
+            raise ValueError(f"{column} is not an indexed column")
+        rows, saved = self._merged(
+            event_type,
+            f"SELECT id_str, course_id FROM events WHERE event_type = ? "
+            f"AND {column} BETWEEN ? AND ?",
+            (event_type, low, high),
+        )
+        ids = [row[0] for row in rows]
+        for _event in saved:
+            value = _event.columns()[column]
+            if value is not None and low <= value <= high:
+                ids.append(_event.id)
+        return ids
+
+    def courses_with_open_due(self, low, high) -> set[str]:
+        """
+        Courses with an unfinished assignment due in [low, high]
+        """
+        rows, saved = self._merged(
+            "AssignmentEvent",
+            "SELECT id_str, course_id FROM events WHERE event_type = 'AssignmentEvent' "
+            "AND is_finished = 0 AND due BETWEEN ? AND ?",
+            (low, high),
+        )
+        courses = {row[1] for row in rows}
+        for _event in saved:
+            columns = _event.columns()
+            if columns["is_finished"] == 0 and columns["due"] is not None:
+                if low <= columns["due"] <= high:
+                    courses.add(columns["course_id"])
+        return courses
+
+    def get_state(self, key, default=None):
+        """
+        Small JSON values kept between runs, e.g. when a sync last ran
+        """
+        with self.lock:
+            if key in self.pending_state:
+                return json.loads(self.pending_state[key])
+        row = self.conn.execute(
+            "SELECT value FROM state WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, key, value):
+        with self.lock:
+            if self.dirty is not None:
+                self.pending_state[key] = json.dumps(value)
+            self.execute_write(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+    def close(self):
+        self.connections.close()
+
+
+class PageCache:
+    """
+    Body hash, ETag and Last-Modified of crawled pages keyed by URL, together with
+    the (event_type, id) of the children parsed from the page last time.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url) -> dict | None:
+        row = self.db.conn.execute(
+            "SELECT hash, etag, last_modified, children FROM pages WHERE url = ?",
+            (url,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "hash": row[0],
+            "etag": row[1],
+            "last_modified": row[2],
+            "children": json.loads(row[3]),
+        }
+
+    def put(self, url, response, children: list) -> None:
+        children = [(__child.__class__.__name__, __child.id) for __child in children]
+        self.db.execute_write(
+            "INSERT OR REPLACE INTO pages (url, hash, etag, last_modified, children) "
+            "VALUES (?, ?, ?, ?, ?)",
             (
-                event_type,
-                id,
+                url,
+                self.hash(response),
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                json.dumps(children),
             ),
         )
-        self.conn.commit()
 
-    def close(self):
-        self.conn.close()
+    @staticmethod
+    def hash(response) -> str:
+        return hashlib.sha256(response.content).hexdigest()
+
+    @staticmethod
+    def conditional_headers(entry: dict | None) -> dict:
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def is_unchanged(self, entry: dict | None, response) -> bool:
+        unchanged = entry is not None and (
+            response.status_code == 304 or entry["hash"] == self.hash(response)
+        )
+        if unchanged:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return unchanged
+
+
+"""
+extract.py below
+"""
+
+FIXTURE_DIR = "./persist/fixtures"
+# Small synthetic pages of every type, kept in the repository for tests
+TEST_FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "tests", "fixtures")
+CAPTURE_FIXTURES = os.getenv("BB_CAPTURE_FIXTURES", "0") == "1"
+
+# URL substring -> page type, used to file captured pages and benchmark results
+PAGE_TYPES = {
+    "tabAction": "course_tab",
+    "modulepage/view": "module_page",
+    "listContent.jsp": "list_content",
+    "action=newAttempt": "new_attempt",
+    "uploadAssignment": "upload_assignment",
+    "execute/announcement": "announcement",
+}
+
+CONTENT_CONTAINER = etree.XPath('//*[@id="content_listContainer"]')
+CONTENT_ICON = etree.XPath("img/@src")
+CONTENT_DETAIL = etree.XPath("div[2]/div[2]/div/span/text()")
+TITLE_LINK = etree.XPath("h3/a/span/text()")
+TITLE_SPAN = etree.XPath("h3/span[2]/text()")
+TITLE_ANY_SPAN = etree.XPath("h3/span/text()")
+MODULE_LINK = etree.XPath("//li/a[1]")
+LINK_TITLE = etree.XPath("span/text()")
+ANNOUNCEMENT_ITEM = etree.XPath(
+    '//*[@id="announcementList"]//li[starts-with(@id, "_")]'
+)
+ANNOUNCEMENT_TITLE = etree.XPath("h3/text()")
+DUE_DATE = etree.XPath('//*[@id="metadata"]/div/div/div[1]/div[2]/text()')
+DUE_TIME = etree.XPath('//*[@id="metadata"]/div/div/div[1]/div[2]/span/text()')
+INSTRUCTIONS = etree.XPath('//*[@id="instructions"]')
+TEXT = etree.XPath("string(.)")
+
+# Content types whose title is always a link, other types fall back to a span
+LINKED_CONTENT_TYPES = ("folder", "assignment", "file", "discussion")
+SPAN_CONTENT_TYPES = ("document", "image")
+CONTENT_DETAILS = {"panopto": "Panopto Video", "discussion": "Discussion"}
+
+
+def page_type(url: str) -> str | None:
+    for key, _type in PAGE_TYPES.items():
+        if key in url:
+            return _type
+    return None
+
+
+def save_fixture(url: str, text: str) -> None:
+    """
+    Keep a copy of a fetched page under persist/fixtures/<page type>/, called for
+    every GET when BB_CAPTURE_FIXTURES is set. The pages are used by benchmark.py
+    """
+    _type = page_type(url)
+    if _type is None or not text:
+        return
+    os.makedirs(os.path.join(FIXTURE_DIR, _type), exist_ok=True)
+    name = hashlib.sha1(url.encode()).hexdigest()[:16] + ".html"
+    with open(os.path.join(FIXTURE_DIR, _type, name), "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def extract_courses(data: str) -> list[tuple[str, str]]:
+    """
+    :return: (course_id, course_name) of every course on the course tab
+    """
+    courses = []
+    for line in data.split("\n"):
+        if "type=Course" in line:
+            # <a href=" /webapps/blackboard/execute/launcher?type=Course&id=_10351_1&url="
+            # target="_top">CHI1000:Chinese_L13L14L15L16</a>
+            course_id = line.split("id=")[1].split("&")[0]
+            course_name = line.split(">")[1].split("<")[0]
+            courses.append((course_id, course_name))
+    return courses
+
+
+def extract_modules(data: str) -> list[tuple[str, str]]:
+    """
+    :return: (content_id, title) of every root folder on a course module page
+    """
+    modules = []
+    for link in MODULE_LINK(etree.HTML(data)):
+        href = link.get("href")
+        if href and "content_id" in href:
+            content_id = href.split("content_id=")[1].split("&")[0]
+            modules.append((content_id, LINK_TITLE(link)[0]))
+    return modules
+
+
+def extract_content_items(data: str) -> list[tuple[str, str, str, str | None]]:
+    """
+    Classify every item of a listContent page in a single pass.
+    :return: (content_id, type, title, detail), detail is None for folders,
+        assignments and files
+    """
+    containers = CONTENT_CONTAINER(etree.HTML(data))
+    if not containers:
+        return []
+    items = []
+    for _li in containers[0].iterchildren("li"):
+        # li's id is "contentListItem:_435903_1"
+        _content_id = _li.get("id").split(":")[1]
+        # '//*[@id="contentListItem:_424214_1"]/img'
+        _type = CONTENT_ICON(_li)[0].split("/")[-1].split("_")[0]
+        div = _li.find("div")
+        if _type in SPAN_CONTENT_TYPES:
+            _title = TITLE_SPAN(div)[0]
+        else:
+            links = TITLE_LINK(div)
+            if links or _type in LINKED_CONTENT_TYPES:
+                _title = links[0]
+            elif _type == "panopto":
+                _title = TITLE_ANY_SPAN(div)[0]
+            else:
+                _title = TITLE_SPAN(div)[0]
+
+        if _type in ("folder", "assignment", "file", "image"):
+            _detail = None
+        elif _type == "document":
+            # '//*[@id="contentListItem:_434678_1"]/div[2]/div[2]/div/span'
+            details = CONTENT_DETAIL(_li)
+            _detail = details[0] if details else ""
+        else:
+            _detail = CONTENT_DETAILS.get(_type, _type)
+        items.append((_content_id, _type, _title, _detail))
+    return items
+
+
+def extract_announcements(
+    data: str, known: set[str] | None = None
+) -> list[tuple[str, str, str]]:
+    """
+    :param known: ids of announcements to skip. The list is not ordered by id or
+        release date, pinned announcements come first and an announcement shows
+        up once its "display after" date passes, so every item is checked.
+    :return: (announcement_id, title, detail) of every item of the announcement list
+    """
+    announcements = []
+    for element in ANNOUNCEMENT_ITEM(etree.HTML(data)):
+        if known and element.get("id") in known:
+            continue
+        raw_detail = TEXT(element).strip().split("\n")
+        raw_detail = [x.strip() for x in raw_detail if x.strip()]
+        announcements.append(
+            (
+                element.get("id"),
+                ANNOUNCEMENT_TITLE(element)[0],
+                "\n".join(raw_detail[1:]),
+            )
+        )
+    return announcements
+
+
+def extract_submission_status(data: str) -> bool:
+    """
+    :return: True if the uploadAssignment page shows a submission
+    """
+    return "Review Submission" in data
+
+
+def extract_assignment_detail(data: str) -> tuple[str, str, str]:
+    """
+    :return: (due date, due time, instructions) of a newAttempt page
+    """
+    html = etree.HTML(data)
+    # //*[@id="metadata"]/div/div/div[1]/div[2]
+    due_date = DUE_DATE(html)[0].strip()  # Sunday, March 10, 2024
+    due_time = DUE_TIME(html)[0].strip()  # 11:59PM
+    detail = TEXT(INSTRUCTIONS(html)[0]).strip()
+    return due_date, due_time, detail
+
+
+# itemSourceType of the calendar events of gradebook columns with a due date
+GRADABLE_ITEM = "blackboard.platform.gradebook2.GradableItem"
+
+
+def parse_calendar_time(value: str | None) -> datetime | None:
+    """
+    :param value: start or end of a selectedCalendarEvents item, in ISO format
+    """
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).astimezone(pytz.timezone("Asia/Shanghai"))
+    except ValueError:
+        return None
+
+
+EXTRACTORS = {
+    "course_tab": extract_courses,
+    "module_page": extract_modules,
+    "list_content": extract_content_items,
+    "new_attempt": lambda data: [extract_assignment_detail(data)],
+    "upload_assignment": lambda data: [extract_submission_status(data)],
+    "announcement": extract_announcements,
+}
 
 
 """
@@ -166,11 +1142,80 @@ event.py below
 """
 
 
+class MissingEvent:
+    """
+    Stands in for a referenced event that is no longer in the database, e.g. the
+    course of a folder left behind when the course was dropped
+    """
+
+    login = None
+
+    def __init__(self, event_type: str, _id: str):
+        self.event_type = event_type
+        self.id = _id
+        self.title = _id
+
+    def __str__(self):
+        return f"{self.title} (removed)"
+
+
+class Reference:
+    """
+    Attribute holding other events.
+    Only the (event_type, id) of the referenced events is pickled, the events are
+    loaded from the database again on first access.
+    """
+
+    def __init__(self, many=False):
+        self.many = many
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.ref_name = name + "_ref"
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if self.name not in obj.__dict__:
+            obj.__dict__[self.name] = self.resolve(obj.__dict__.get(self.ref_name))
+        return obj.__dict__[self.name]
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+    @staticmethod
+    def event_ref(value) -> tuple[str, str]:
+        if isinstance(value, MissingEvent):
+            return (value.event_type, value.id)
+        return (value.__class__.__name__, value.id)
+
+    def to_ref(self, value):
+        if self.many:
+            return [self.event_ref(__event) for __event in value]
+        return None if value is None else self.event_ref(value)
+
+    def resolve(self, ref):
+        if not self.many:
+            if ref is None:
+                return None
+            _found = BaseEvent.db.filter_events(ref[0], id=ref[1])
+            return _found[0] if _found else MissingEvent(*ref)
+        _events = []
+        for event_type, _id in ref or []:
+            _found = BaseEvent.db.filter_events(event_type, id=_id)
+            if _found:
+                _events.append(_found[0])
+        return _events
+
+
 class BaseEvent:
     db = Database("./persist/events.db")
     title: str
     id: str
-    login: Login
+    # Not persisted, loaded events use the login given to BaseEvent.init
+    login: Login | None = None
+    # Runtime attributes that are never pickled
+    transient = ("login",)
 
     def __init__(self, title, _id, _login):
         self.title = title
@@ -178,9 +1223,43 @@ class BaseEvent:
         self.login = _login
         self.save()  # 自动保存到数据库
 
+    @classmethod
+    def init(cls, _login):
+        cls.login = _login
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.transient:
+            state.pop(name, None)
+        for klass in self.__class__.__mro__:
+            for name, attr in vars(klass).items():
+                if isinstance(attr, Reference) and name in state:
+                    state[attr.ref_name] = attr.to_ref(state.pop(name))
+        return state
+
     def save(self):
         self.db.add_event(self)
 
+    def columns(self) -> dict:
+        """
+        Values of the indexed columns of Database.columns
+        """
+        return {
+            "course_id": None,
+            "parent_id": None,
+            "title": self.title,
+            "path": None,
+            "due": None,
+            "is_finished": None,
+            "detail_hash": None,
+        }
+
+    def fingerprint(self) -> str:
+        """
+        Hash of the indexed columns, changes whenever a user visible field changes
+        """
+        return self.db.fingerprint(self.columns())
+
     @classmethod
     def get(cls, **kwargs):
         return cls.db.get_event(cls.__name__, **kwargs)
@@ -206,38 +1285,51 @@ class BaseEvent:
 
 class CourseEvent(BaseEvent):
     def __init__(self, course_id, course_name, _login):
-        self.root_content_list = []
         super().__init__(title=course_name, _id=course_id, _login=_login)
 
-    def add_content_list(self, content_list):
-        if content_list.__class__.__name__ == "ContentListEvent":
-            content_list = [content_list]
-        elif content_list.__class__.__name__ == "list":
-            pass
-        else:
-            raise ValueError("content_list should be ContentListEvent or list")
-        for __content_list in content_list:
-            if __content_list.id in [
-                __content.id for __content in self.root_content_list
-            ]:
-                continue
-            self.root_content_list.append(__content_list)
-        self.save()
+    def __setstate__(self, state):
+        # Older versions kept the root folders on the course, they are the stored
+        # ContentListEvent rows without a parent now
+        state.pop("root_content_list", None)
+        state.pop("root_content_list_ref", None)
+        self.__dict__.update(state)
+
+    def delete_self(self):
+        # Its contents, assignments and announcements would refer to a missing course
+        self.db.delete_course(self.id)
 
     def __str__(self):
         return f"{self.title}"
 
 
 class CalendarEvent(BaseEvent):
-    start: datetime
-    end: datetime
+    start: str
+    end: str
     location: CourseEvent | str
     sub_title: str
     name: str
     description: str
+    # Course id of a course calendar, "PERSONAL" or "INSTITUTION" otherwise
+    calendar_id: str | None = None
+    # What the event was generated from, GRADABLE_ITEM and the gradebook column
+    # id for a due date. The column id is not the content id of the assignment.
+    item_source_type: str | None = None
+    item_source_id: str | None = None
 
     def __init__(
-        self, start, end, title, location, sub_title, _id, name, description, _login
+        self,
+        start,
+        end,
+        title,
+        location,
+        sub_title,
+        _id,
+        name,
+        description,
+        _login,
+        calendar_id=None,
+        item_source_type=None,
+        item_source_id=None,
     ):
         self.start = start
         self.end = end
@@ -245,14 +1337,27 @@ class CalendarEvent(BaseEvent):
         self.sub_title = sub_title
         self.name = name
         self.description = description
+        self.calendar_id = calendar_id
+        self.item_source_type = item_source_type
+        self.item_source_id = item_source_id
         super().__init__(title=title, _id=_id, _login=_login)
 
+    def get_end(self) -> datetime | None:
+        return parse_calendar_time(self.end)
+
+    def columns(self) -> dict:
+        columns = super().columns()
+        end = self.get_end()
+        columns["due"] = end.timestamp() if end else None
+        return columns
+
     def __str__(self):
         return f"{self.title}"
 
 
 class ContentEvent(BaseEvent):
-    course: CourseEvent
+    course: CourseEvent = Reference()
+    parent_id: str | None = None
     path: str
     detail: str
     metadata: dict = {}
@@ -265,24 +1370,34 @@ class ContentEvent(BaseEvent):
         path,
         detail="",
         metadata=None,
+        parent_id=None,
     ):
         if metadata is None:
             metadata = {"detail": detail}
         self.course = _course
+        self.parent_id = parent_id
         self.path = path
         self.detail = detail
-        self.metadata.update(metadata)
+        self.metadata = dict(metadata)
         super().__init__(title=content_name, _id=content_id, _login=_course.login)
 
     def get_detail(self) -> str:
         return self.metadata["detail"] if "detail" in self.metadata else self.detail
 
+    def columns(self) -> dict:
+        columns = super().columns()
+        columns["course_id"] = self.course.id
+        columns["parent_id"] = self.parent_id
+        columns["path"] = self.path
+        columns["detail_hash"] = hashlib.sha1(self.get_detail().encode()).hexdigest()
+        return columns
+
     def __str__(self):
         return f"{self.course} {self.title}"
 
 
 class AnnouncementEvent(BaseEvent):
-    course: CourseEvent
+    course: CourseEvent = Reference()
     metadata: dict = {}
 
     def __init__(
@@ -302,75 +1417,218 @@ class AnnouncementEvent(BaseEvent):
     def get_detail(self):
         return self.metadata.get("detail", "")
 
+    def columns(self) -> dict:
+        columns = super().columns()
+        columns["course_id"] = self.course.id
+        columns["detail_hash"] = hashlib.sha1(self.get_detail().encode()).hexdigest()
+        return columns
+
+
+class DueDateResolver:
+    """
+    Due dates of every assignment from the synced calendar. A due date event
+    only links to the gradebook column of the assignment, so it is matched by
+    course id and title; titles shared by several columns of a course are left
+    out. The calendar is synced on first use, assignments it lacks fall back to
+    their newAttempt page.
+    """
+
+    enabled = os.getenv("BB_CALENDAR_DUE", "1") == "1"
+
+    def __init__(self):
+        self.due_dates = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, course_id, title) -> datetime | None:
+        if not self.enabled:
+            return None
+        with self.lock:
+            if self.due_dates is None:
+                self.due_dates = self._load()
+            due = self.due_dates.get((course_id, title.strip()))
+            if due is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return due
+
+    @staticmethod
+    def _load() -> dict[tuple[str, str], datetime]:
+        try:
+            CalendarRetriever.sync()
+        except Exception as e:
+            print(f"Calendar not available, reading due dates from assignments: {e}")
+            return {}
+        return DueDateResolver.index(CalendarEvent.all())
+
+    @staticmethod
+    def index(events: list[CalendarEvent]) -> dict[tuple[str, str], datetime]:
+        """
+        :return: (course id, title) -> due date of the gradable items
+        """
+        due_dates = {}
+        ambiguous = set()
+        for _event in events:
+            end = _event.get_end()
+            if _event.item_source_type != GRADABLE_ITEM or end is None:
+                continue
+            key = (_event.calendar_id, _event.name.strip())
+            if key in due_dates and due_dates[key] != end:
+                ambiguous.add(key)
+            due_dates[key] = end
+        for key in ambiguous:
+            del due_dates[key]
+        return due_dates
+
+    def clear(self):
+        with self.lock:
+            self.due_dates = None
+
 
 class AssignmentEvent(ContentEvent):
+    # Detail pages are refetched depending on how likely they are to have changed
+    force_refresh = os.getenv("BB_FORCE_DETAIL_REFRESH", "0") == "1"
+    ttl_near_due = timedelta(minutes=int(os.getenv("BB_DETAIL_TTL_NEAR", "10")))
+    ttl_default = timedelta(minutes=int(os.getenv("BB_DETAIL_TTL", "360")))
+    ttl_submitted = timedelta(minutes=int(os.getenv("BB_DETAIL_TTL_SUBMITTED", "1440")))
+    near_due = timedelta(days=2)
+    archive_after = timedelta(days=int(os.getenv("BB_DETAIL_ARCHIVE_DAYS", "7")))
+    detail_fetches = 0
+    detail_cache_hits = 0
+    due_dates = DueDateResolver()
+
     def __init__(
-        self, _course: CourseEvent, assignment_id, assignment_name, path, metadata=None
+        self,
+        _course: CourseEvent,
+        assignment_id,
+        assignment_name,
+        path,
+        metadata=None,
+        parent_id=None,
     ):
         if metadata is None:
             metadata = {}
+        # Look up the stored detail before the constructor overwrites the row
+        cached = self.db.filter_events(self.__class__.__name__, id=assignment_id)
         super().__init__(
             _course=_course,
             content_id=assignment_id,
             content_name=assignment_name,
             path=path,
             metadata=metadata,
+            parent_id=parent_id,
         )
-        self._get_detail()
+        if cached and not self.needs_refresh(cached[0].metadata):
+            self.metadata = cached[0].metadata
+            AssignmentEvent.detail_cache_hits += 1
+        else:
+            self._get_detail(cached[0].metadata if cached else None)
         self.save()
 
-    def _get_detail(self) -> None:
+    @classmethod
+    def needs_refresh(cls, metadata: dict) -> bool:
+        """
+        Refresh policy of the cached detail:
+        often close to the due date, rarely once submitted, never for long-past due.
+        """
+        if cls.force_refresh or "fetched_at" not in metadata:
+            return True
+        now = datetime.now(pytz.timezone("Asia/Shanghai"))
+        age = now - metadata["fetched_at"]
+        due = metadata["due"]
+        if now - due > cls.archive_after:
+            return False
+        if abs(due - now) <= cls.near_due:
+            return age >= cls.ttl_near_due
+        if metadata["is_finished"]:
+            return age >= cls.ttl_submitted
+        return age >= cls.ttl_default
+
+    def _get_detail(self, previous: dict | None = None) -> None:
+        """
+        Fetch the submission status. The newAttempt page is only fetched when the
+        calendar lacks the due date or the stored instructions are older than
+        ttl_default.
+        :param previous: the stored metadata
+        """
+        previous = previous or {}
         url = (
             f"https://bb.cuhk.edu.cn/webapps/assignment/uploadAssignment?course_id={self.course.id}"
             f"&content_id={self.id}"
         )
+        AssignmentEvent.detail_fetches += 1
         r = self.login.get(url)
-        if "Review Submission" in r.text:
-            is_finished = True
-        else:
-            is_finished = False
+        is_finished = extract_submission_status(r.text)
 
-        url_new_attempt = (
-            f"https://bb.cuhk.edu.cn/webapps/assignment/uploadAssignment?action=newAttempt&"
-            f"course_id={self.course.id}&content_id={self.id}"
+        now = datetime.now(pytz.timezone("Asia/Shanghai"))
+        due = self.due_dates.get(self.course.id, self.title)
+        detail = previous.get("detail")
+        detail_fetched_at = previous.get(
+            "detail_fetched_at", previous.get("fetched_at")
         )
-        r2 = self.login.get(url_new_attempt)
-        r2 = etree.HTML(r2.text)
-        # Get due date
-        # //*[@id="metadata"]/div/div/div[1]/div[2]
-        due_date = r2.xpath('//*[@id="metadata"]/div/div/div[1]/div[2]/text()')[
-            0
-        ].strip()  # Sunday, March 10, 2024
-        due_time = r2.xpath('//*[@id="metadata"]/div/div/div[1]/div[2]/span/text()')[
-            0
-        ].strip()  # 11:59PM
-        # parse datetime object beijing time
-        # print(f'Due: {due_date} {due_time}')
-        try:
-            due = datetime.strptime(due_date + " " + due_time, "%A, %B %d, %Y %I:%M %p")
-        except ValueError:
-            due = datetime.now() + timedelta(days=1)
-            print(f"Due date not found for {self.course} {self.title}, set to tomorrow")
-            notify_email(
-                "warning",
-                f"Due date not found for {self.course} {self.title}. Set to tomorrow.",
+        if (
+            due is None
+            or detail is None
+            or detail_fetched_at is None
+            or self.force_refresh
+            or now - detail_fetched_at >= self.ttl_default
+        ):
+            url_new_attempt = (
+                f"https://bb.cuhk.edu.cn/webapps/assignment/uploadAssignment?action=newAttempt&"
+                f"course_id={self.course.id}&content_id={self.id}"
             )
-        # due = datetime.strptime(due_date + " " + due_time, "%A, %B %d, %Y %I:%M %p")
-        due = due.astimezone(pytz.timezone("Asia/Shanghai"))
-        if datetime.now().astimezone(pytz.timezone("Asia/Shanghai")) > due:
+            r2 = self.login.get(url_new_attempt)
+            due_date, due_time, detail = extract_assignment_detail(r2.text)
+            detail_fetched_at = now
+            # parse datetime object beijing time
+            # print(f'Due: {due_date} {due_time}')
+            try:
+                due = datetime.strptime(
+                    due_date + " " + due_time, "%A, %B %d, %Y %I:%M %p"
+                ).astimezone(pytz.timezone("Asia/Shanghai"))
+            except ValueError:
+                if due is None:
+                    due = (datetime.now() + timedelta(days=1)).astimezone(
+                        pytz.timezone("Asia/Shanghai")
+                    )
+                    print(
+                        f"Due date not found for {self.course} {self.title}, set to tomorrow"
+                    )
+                    notify_email(
+                        "warning",
+                        f"Due date not found for {self.course} {self.title}. Set to tomorrow.",
+                    )
+        if now > due:
             is_finished = True
 
-        # Get detail
-        _li = r2.xpath('//*[@id="instructions"]')[0]
-        # parse all text in li
-        detail = _li.xpath("string(.)").strip()
-
-        metadata = {"is_finished": is_finished, "due": due, "detail": detail}
+        metadata = {
+            "is_finished": is_finished,
+            "due": due,
+            "detail": detail,
+            "fetched_at": now,
+            "detail_fetched_at": detail_fetched_at,
+        }
         self.metadata = metadata
 
+    def refresh_detail(self) -> None:
+        if not self.needs_refresh(self.metadata):
+            AssignmentEvent.detail_cache_hits += 1
+            return
+        self._get_detail(self.metadata)
+        self.save()
+
     def get_due(self) -> datetime:
         return self.metadata["due"]
 
+    def columns(self) -> dict:
+        columns = super().columns()
+        if "due" in self.metadata:
+            columns["due"] = self.get_due().timestamp()
+            columns["is_finished"] = int(self.is_finished())
+        return columns
+
     def is_finished(self) -> bool:
         return self.metadata["is_finished"]
 
@@ -379,159 +1637,489 @@ class AssignmentEvent(ContentEvent):
 
 
 class ContentListEvent(ContentEvent):
-    contents: list[ContentEvent]
+    contents: list[ContentEvent] = Reference(many=True)
     contents_num: int
+    # Merkle digest of the subtree, see update_digest
+    digest: str | None = None
+    # Set when the listing is unchanged and the stored subtree is reused as is
+    settled: bool = False
+    transient = ("login", "settled")
+    page_cache = PageCache(BaseEvent.db)
 
-    def __init__(self, _course: CourseEvent, content_id, content_name, path):
+    def __init__(
+        self, _course: CourseEvent, content_id, content_name, path, parent_id=None
+    ):
         self.contents_num = 0
         self.contents = []
         super().__init__(
-            _course=_course, content_id=content_id, content_name=content_name, path=path
+            _course=_course,
+            content_id=content_id,
+            content_name=content_name,
+            path=path,
+            parent_id=parent_id,
         )
-        self.course.add_content_list(self)
 
     def add_content(self, content: ContentEvent):
-        self.contents.append(content)
-        self.contents_num += 1
-        self.save()
-
-    def recursive_get_content_data(self):
-        url = (
+        with self.db.lock:
+            self.contents.append(content)
+            self.contents_num += 1
+            self.save()
+
+    @property
+    def listing_url(self) -> str:
+        return (
             f"https://bb.cuhk.edu.cn/webapps/blackboard/content/listContent.jsp?course_id={self.course.id}"
             f"&content_id={self.id}&mode=reset"
         )
-        r = self.login.get(url=url)
-        _html = etree.HTML(r.text)
-        # //*[@id="content_listContainer"]
-        if len(_html.xpath('//*[@id="content_listContainer"]')) <= 0:
+
+    def recursive_get_content_data(self):
+        """
+        Fetch the listing of this folder.
+        """
+        r = self.fetch_listing()
+        if r is not None:
+            self.build_contents(r, extract_content_items(r.text))
+
+    def fetch_listing(self) -> requests.Response | None:
+        """
+        :return: the listing page, or None if it is unchanged and the stored
+            children were reused
+        """
+        cached = self.page_cache.get(self.listing_url)
+        r = self.login.get(
+            url=self.listing_url, headers=PageCache.conditional_headers(cached)
+        )
+        if self.page_cache.is_unchanged(cached, r) and self._reuse_contents(
+            cached["children"]
+        ):
+            return None
+        if r.status_code == 304:
+            # The stored children are gone, a 304 has no body to parse
+            r = self.login.get(url=self.listing_url)
+        return r
+
+    def build_contents(self, r: requests.Response, items: list) -> None:
+        """
+        Create the children from the items extracted from the listing page
+        """
+        self.add_items(items)
+        self.page_cache.put(self.listing_url, r, self.contents)
+
+    def _reuse_contents(self, children: list) -> bool:
+        """
+        Load the children parsed from an unchanged page back from the database.
+        Sub folders are left empty, an unchanged listing says nothing about their
+        own pages, so the crawler requests each of them again.
+        :return: False if any child is missing and the page has to be parsed again
+        """
+        _contents = []
+        for event_type, _id in children:
+            _events = self.db.filter_events(event_type, id=_id)
+            if not _events:
+                return False
+            _contents.append(_events[0])
+        for __content in _contents:
+            self._reattach(__content)
+            if isinstance(__content, ContentListEvent):
+                __content.contents = []
+                __content.contents_num = 0
+        with self.db.lock:
+            self.contents = _contents
+            self.contents_num = len(_contents)
+        return True
+
+    def _reattach(self, __content: ContentEvent):
+        if "login" in __content.__dict__:
+            # Built in this run
             return
-        for _li in _html.xpath('//*[@id="content_listContainer"]')[0]:
-            # li's id is "contentListItem:_435903_1"
-            _li_id = _li.xpath("@id")[0]
-            _content_id = _li_id.split(":")[1]
-            # '//*[@id="contentListItem:_424214_1"]/img'
-            _type = _li.xpath("img/@src")[0].split("/")[-1].split("_")[0]
+        __content.login = self.login
+        __content.course = self.course
+        if isinstance(__content, AssignmentEvent):
+            __content.refresh_detail()
+
+    def reuse_stored_contents(self):
+        """
+        Reuse the stored subtree of a settled folder without any request.
+        """
+        for __content in self.contents:
+            self._reattach(__content)
+            if isinstance(__content, ContentListEvent):
+                __content.settled = True
+
+    def update_digest(self) -> str:
+        """
+        Merkle digest over the ids and fingerprints of the children and the digests
+        of the sub folders. Saved only when it changed.
+        """
+        entries = []
+        for child in self.contents:
+            child_digest = (
+                child.update_digest() if isinstance(child, ContentListEvent) else None
+            )
+            entries.append((child.id, child.fingerprint(), child_digest))
+        digest = hashlib.sha1(json.dumps(sorted(entries)).encode()).hexdigest()
+        if digest != self.digest:
+            self.digest = digest
+            self.save()
+        return digest
+
+    def parse_contents(self, data: str):
+        self.add_items(extract_content_items(data))
+
+    def add_items(self, items: list):
+        for _content_id, _type, _title, _detail in items:
+            _path = self.path + "/" + _title
             if _type == "folder":
-                # '//*[@id="anonymous_element_8"]/a/span'
-                div = _li.xpath("div[1]")
-                _title = div[0].xpath("h3/a/span/text()")[0]
                 __content = ContentListEvent(
-                    self.course, _content_id, _title, self.path + "/" + _title
-                )
-                self.add_content(__content)
-            elif _type == "document":
-                div = _li.xpath("div[1]")
-                _title = div[0].xpath("h3/span[2]/text()")[0]
-                # '//*[@id="contentListItem:_434678_1"]/div[2]/div[2]/div/span'
-                try:
-                    _detail = _li.xpath("div[2]/div[2]/div/span/text()")[0]
-                except IndexError:
-                    # raise ValueError(f"Detail not found for {_title}, _li: {etree.tostring(_li)}")
-                    _detail = ""
-                __content = ContentEvent(
-                    self.course, _content_id, _title, self.path + "/" + _title, _detail
+                    self.course, _content_id, _title, _path, parent_id=self.id
                 )
-                self.add_content(__content)
             elif _type == "assignment":
-                div = _li.xpath("div[1]")
-                _title = div[0].xpath("h3/a/span/text()")[0]
                 __content = AssignmentEvent(
-                    self.course, _content_id, _title, self.path + "/" + _title
+                    self.course, _content_id, _title, _path, parent_id=self.id
                 )
-                self.add_content(__content)
-            elif _type == "file":
-                # //*[@id="anonymous_element_8"]/a/span
-                div = _li.xpath("div[1]")
-                _title = div[0].xpath("h3/a/span/text()")[0]
+            elif _type in ("file", "image"):
                 __content = FileEvent(
-                    self.course, _content_id, _title, self.path + "/" + _title
+                    self.course, _content_id, _title, _path, parent_id=self.id
                 )
-                self.add_content(__content)
-            elif _type == "image":
-                div = _li.xpath("div[1]")
-                _title = div[0].xpath("h3/span[2]/text()")[0]
-                __content = FileEvent(
-                    self.course, _content_id, _title, self.path + "/" + _title
-                )
-                self.add_content(__content)
-            elif _type == "panopto":
-                div = _li.xpath("div[1]")
-                _title = (
-                    div[0].xpath("h3/a/span/text()")[0]
-                    if div[0].xpath("h3/a/span/text()")
-                    else div[0].xpath("h3/span/text()")[0]
-                )
-                _detail = "Panopto Video"
-                __content = ContentEvent(
-                    self.course, _content_id, _title, self.path + "/" + _title, _detail
-                )
-                self.add_content(__content)
-            elif _type == "discussion":
-                div = _li.xpath("div[1]")
-                _title = div[0].xpath("h3/a/span/text()")[0]
-                _detail = "Discussion"
+            else:
                 __content = ContentEvent(
-                    self.course, _content_id, _title, self.path + "/" + _title, _detail
+                    self.course, _content_id, _title, _path, _detail, parent_id=self.id
                 )
-                self.add_content(__content)
+            self.add_content(__content)
+
+    def get_all_contents(self) -> list[ContentEvent]:
+        if self.contents_num == 0:
+            self.recursive_get_content_data()
+
+        _all = []
+        for child in self.contents:
+            if isinstance(child, ContentListEvent):
+                _all.extend(child.get_all_contents())
             else:
-                try:
-                    div = _li.xpath("div[1]")
-                    _title = div[0].xpath("h3/a/span/text()")[0]
-                    _detail = _type
-                    __content = ContentEvent(
-                        self.course,
-                        _content_id,
-                        _title,
-                        self.path + "/" + _title,
-                        _detail,
-                    )
-                    self.add_content(__content)
-                except IndexError:
-                    div = _li.xpath("div[1]")
-                    _title = div[0].xpath("h3/span[2]/text()")[0]
-                    _detail = _type
-                    __content = ContentEvent(
-                        self.course,
-                        _content_id,
-                        _title,
-                        self.path + "/" + _title,
-                        _detail,
-                    )
-                    self.add_content(__content)
-                except Exception:
-                    raise ValueError(
-                        f"Unknown content type: {_type} when "
-                        f"parsing Content at {self.course}, path: {self.path}"
-                    )
+                _all.append(child)
+        self.save()
+        return _all
+
+    def __str__(self):
+        return f"{self.course} {self.title} Folder"
+
+
+class FileEvent(ContentEvent):
+    def __init__(
+        self,
+        _course,
+        content_id,
+        content_name,
+        path,
+        detail="",
+        metadata=None,
+        parent_id=None,
+    ):
+        super().__init__(
+            _course,
+            content_id,
+            content_name,
+            path,
+            detail=detail,
+            metadata=metadata,
+            parent_id=parent_id,
+        )
+
+    def __str__(self):
+        return f"{self.course} {self.title}"
+
+
+"""
+crawler.py below
+"""
+
+CRAWL_CONCURRENCY = int(os.getenv("BB_CRAWL_CONCURRENCY", "8"))
+PARSE_WORKERS = int(os.getenv("BB_PARSE_WORKERS", "2"))
+STAGE_QUEUE_SIZE = int(os.getenv("BB_STAGE_QUEUE_SIZE", "32"))
+
+
+class PollSchedule:
+    """
+    Adaptive polling interval of each course, kept in the state table together
+    with its change history. The interval halves when a poll finds a change and
+    grows by half when it does not, bounded by [minimum, maximum]. Boosted
+    targets, those with an unfinished assignment due soon, are polled at the
+    minimum interval. The maximum bounds how late a change is found.
+    """
+
+    # Scheduler ticks are jittered, a target is due slightly before its interval
+    # has passed so that it is not put off by a whole tick
+    slack = 60
+
+    def __init__(
+        self, kind: str, minimum: timedelta, maximum: timedelta, initial: timedelta
+    ):
+        self.kind = kind
+        self.minimum = minimum.total_seconds()
+        self.maximum = maximum.total_seconds()
+        self.initial = min(max(initial.total_seconds(), self.minimum), self.maximum)
+
+    def _key(self, _id) -> str:
+        return f"poll:{self.kind}:{_id}"
+
+    def is_due(self, _id, boost=False, now: float | None = None) -> bool:
+        state = BaseEvent.db.get_state(self._key(_id))
+        if state is None:
+            return True
+        interval = self.minimum if boost else min(state["interval"], self.maximum)
+        if now is None:
+            now = time.time()
+        return now - state["polled_at"] >= interval - self.slack
+
+    def record(
+        self, _id, digest: str, boost=False, polled_at: float | None = None
+    ) -> bool:
+        """
+        Record a poll and adapt the interval of the target.
+        :param digest: digest of the target after the poll, it changed if the
+            digest differs from the last poll
+        :param polled_at: when the poll started, the next one is due an interval
+            after it
+        :return: whether the target changed
+        """
+        key = self._key(_id)
+        now = time.time() if polled_at is None else polled_at
+        state = BaseEvent.db.get_state(key)
+        if state is None:
+            # First poll, nothing to compare with
+            state = {"polls": 0, "changes": 0, "changed_at": None}
+            changed = False
+            interval = self.initial
+        elif digest != state["digest"]:
+            changed = True
+            interval = state["interval"] / 2
+            state["changes"] += 1
+            state["changed_at"] = now
+        else:
+            changed = False
+            interval = state["interval"] * 1.5
+        if boost:
+            interval = self.minimum
+        state["interval"] = min(max(interval, self.minimum), self.maximum)
+        state["digest"] = digest
+        state["polls"] += 1
+        state["polled_at"] = now
+        BaseEvent.db.set_state(key, state)
+        return changed
+
+
+# Quiet courses back off up to the cadence every course was crawled at before
+COURSE_SCHEDULE = PollSchedule(
+    "course",
+    minimum=timedelta(minutes=int(os.getenv("BB_COURSE_POLL_MIN_MINUTES", "10"))),
+    maximum=timedelta(minutes=int(os.getenv("BB_COURSE_POLL_MAX_MINUTES", "30"))),
+    initial=timedelta(minutes=int(os.getenv("BB_COURSE_POLL_MAX_MINUTES", "30"))),
+)
+
+
+class Stage:
+    """
+    A pool of worker threads draining a bounded queue.
+    func does the work of the stage and hands its result to the next stage, a
+    full queue blocks the previous stage. Exceptions are passed to failed.
+    """
+
+    def __init__(self, name, func, workers, failed, maxsize=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.failed = failed
+        self.queue = queue.Queue(maxsize=maxsize or STAGE_QUEUE_SIZE)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.total_depth = 0
+        self.started = 0.0
+        self.elapsed = 0.0
+
+    def start(self) -> "Stage":
+        self.started = time.perf_counter()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def put(self, item: tuple):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+            self.total_depth += depth
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            start = time.perf_counter()
+            try:
+                self.func(*item)
+            except Exception as e:
+                self.failed(item, e)
+            with self.lock:
+                self.processed += 1
+                self.busy += time.perf_counter() - start
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "workers": self.workers,
+            "processed": self.processed,
+            "utilisation": (
+                self.busy / (self.workers * self.elapsed) if self.elapsed else 0.0
+            ),
+            "max_depth": self.max_depth,
+            "mean_depth": (
+                self.total_depth / self.processed if self.processed else 0.0
+            ),
+        }
 
-    def get_all_contents(self) -> list[ContentEvent]:
-        if self.contents_num == 0:
-            self.recursive_get_content_data()
 
-        _all = []
-        for child in self.contents:
-            if isinstance(child, ContentListEvent):
-                _all.extend(child.get_all_contents())
-            else:
-                _all.append(child)
-        self.save()
-        return _all
+def fan_out(func, courses: list[CourseEvent], desc: str, fallback, max_workers=None):
+    """
+    Run func for every course on a bounded thread pool.
+    Results are yielded in course order, each as soon as it and every course
+    before it are done. A course whose func raises is reported and replaced by
+    fallback(course), the other courses are not affected.
+    :return: iterator of (course, result)
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or CRAWL_CONCURRENCY) as executor:
+        futures = [executor.submit(func, __course) for __course in courses]
+        for __course, future in zip(courses, tqdm(futures, desc=desc)):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"{desc} failed for {__course}, using stored data: {e}")
+                result = fallback(__course)
+            yield __course, result
+
+
+class ContentCrawler:
+    """
+    Walk content trees breadth-first through fetch, parse and build stages.
+    Listing pages are fetched by max_workers threads, parsed by BB_PARSE_WORKERS
+    threads and turned into events by max_workers threads, so parsing overlaps
+    the network waits of the other stages. The events produced are the same as
+    calling ContentListEvent.get_all_contents on every root.
+
+    Every folder of a crawled course is requested with the ETag and Last-Modified
+    of its last listing, an unchanged folder (304 or same body) reuses its stored
+    children without parsing. A change anywhere in the tree is therefore found by
+    the next crawl of the course, within its COURSE_SCHEDULE interval. Settled
+    folders, the stored roots of courses that are not crawled, reuse their whole
+    stored subtree without any request.
+    """
 
-    def __str__(self):
-        return f"{self.course} {self.title} Folder"
+    skipped_folders = 0
+    # Stats of the stages of the last crawl
+    stage_stats: list[dict] = []
+    # Courses with an unfinished assignment due soon, loaded once per cycle
+    boosted_courses: set[str] | None = None
 
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or CRAWL_CONCURRENCY
 
-class FileEvent(ContentEvent):
-    def __init__(
-        self, _course, content_id, content_name, path, detail="", metadata=None
-    ):
-        super().__init__(
-            _course, content_id, content_name, path, detail=detail, metadata=metadata
-        )
+    @classmethod
+    def is_boosted(cls, course_id) -> bool:
+        """
+        Whether the course has an unfinished assignment due within near_due
+        """
+        if cls.boosted_courses is None:
+            now = time.time()
+            cls.boosted_courses = BaseEvent.db.courses_with_open_due(
+                now, now + AssignmentEvent.near_due.total_seconds()
+            )
+        return course_id in cls.boosted_courses
 
-    def __str__(self):
-        return f"{self.course} {self.title}"
+    def crawl(self, root_contents: list[ContentListEvent]) -> list[ContentEvent]:
+        return list(self.iter_crawl(root_contents))
+
+    def iter_crawl(self, root_contents: list[ContentListEvent]):
+        """
+        Yield the contents of every folder as soon as the folder is built, while
+        the remaining folders are still being fetched. Digests are updated once the
+        generator is exhausted.
+        """
+        self.done = queue.Queue()
+        self.build = Stage("build", self._build, self.max_workers, self._failed)
+        self.parse = Stage("parse", self._parse, PARSE_WORKERS, self._failed)
+        self.fetch = Stage("fetch", self._fetch, self.max_workers, self._failed)
+        stages = [self.fetch, self.parse, self.build]
+        for stage in stages:
+            stage.start()
+
+        seen = set()
+        bar = tqdm(total=len(root_contents), desc="Retrieving Full Content")
+        try:
+            for folder in root_contents:
+                self.fetch.put((folder,))
+            pending = len(root_contents)
+            while pending:
+                folder, error = self.done.get()
+                pending -= 1
+                if error is not None:
+                    raise error
+                bar.update(1)
+                for child in folder.contents:
+                    if isinstance(child, ContentListEvent):
+                        pending += 1
+                        bar.total += 1
+                        self.fetch.put((child,))
+                    elif child.id not in seen:
+                        seen.add(child.id)
+                        yield child
+        finally:
+            for stage in stages:
+                stage.close()
+            bar.close()
+            ContentCrawler.stage_stats = [stage.stats() for stage in stages]
+        for root_content in root_contents:
+            root_content.update_digest()
+
+    def _fetch(self, folder: ContentListEvent):
+        if folder.settled:
+            folder.reuse_stored_contents()
+            ContentCrawler.skipped_folders += 1
+        elif folder.contents_num == 0:
+            r = folder.fetch_listing()
+            if r is not None:
+                self.parse.put((folder, r))
+                return
+        self.done.put((folder, None))
+
+    def _parse(self, folder: ContentListEvent, r: requests.Response):
+        self.build.put((folder, r, extract_content_items(r.text)))
+
+    def _build(self, folder: ContentListEvent, r: requests.Response, items: list):
+        folder.build_contents(r, items)
+        self.done.put((folder, None))
+
+    def _failed(self, item: tuple, error: Exception):
+        self.done.put((item[0], error))
+
+    @staticmethod
+    def stats() -> str:
+        return ", ".join(
+            f"{_stats['name']} {_stats['utilisation']:.0%} busy "
+            f"({_stats['workers']} workers, {_stats['processed']} pages, "
+            f"queue max {_stats['max_depth']} mean {_stats['mean_depth']:.1f})"
+            for _stats in ContentCrawler.stage_stats
+        )
 
 
 """
@@ -567,16 +2155,29 @@ ASSIGNMENT = "assignment"
 DISCUSSION = "discussion"
 
 
+CALENDAR_WINDOW = timedelta(days=int(os.getenv("BB_CALENDAR_WINDOW_DAYS", "30")))
+CALENDAR_FULL_SYNC_INTERVAL = timedelta(
+    hours=int(os.getenv("BB_CALENDAR_FULL_SYNC_HOURS", "24"))
+)
+
+
 class CalendarRetriever(BaseRetriever):
+    # Syncs closer together than this are skipped, e.g. retrieve and the due
+    # date resolver in the same run
+    min_sync_interval = 60
+    last_sync = 0.0
+
     def retrieve(self, query: str) -> list[CalendarEvent]:
         """
         retrieve data from blackboard
         :param query: Default is None. Get all CalendarEvents
         :return: list of data (BaseEvent)
         """
-        return self.get_calendar_data(2, YEARS)
+        self.sync()
+        return CalendarEvent.all()
 
-    def _parse_calendar_data(self, data) -> list[CalendarEvent]:
+    @classmethod
+    def _parse_calendar_data(cls, data) -> list[CalendarEvent]:
         events = []
         for item in data:
             _event = CalendarEvent(
@@ -588,53 +2189,94 @@ class CalendarRetriever(BaseRetriever):
                 _id=item["id"],
                 name=item["title"],
                 description=item["eventType"],
-                _login=self.login,
+                _login=cls.login,
+                calendar_id=item.get("calendarId"),
+                item_source_type=item.get("itemSourceType"),
+                item_source_id=item.get("itemSourceId"),
             )
             events.append(_event)
         return events
 
-    def get_calendar_data_period(self, start, end) -> list[CalendarEvent]:
+    @classmethod
+    def sync(cls) -> list[CalendarEvent]:
+        """
+        Merge the part of the calendar that can still change into the stored events.
+        Only [now - 1 day, now + BB_CALENDAR_WINDOW_DAYS] is fetched, the whole
+        +-2 years every BB_CALENDAR_FULL_SYNC_HOURS. Stored events in the fetched
+        range that the server no longer returns are deleted.
+        :return: the events fetched
+        """
+        now = time.time()
+        if now - cls.last_sync < cls.min_sync_interval:
+            return []
+        last_full_sync = BaseEvent.db.get_state("calendar_full_sync", 0)
+        full = now - last_full_sync >= CALENDAR_FULL_SYNC_INTERVAL.total_seconds()
+        if full:
+            start, end = cls._period(2, YEARS)
+        else:
+            start = int((now - timedelta(days=1).total_seconds()) * 1000)
+            end = int((now + CALENDAR_WINDOW.total_seconds()) * 1000)
+        data = cls._get_calendar_json(start, end)
+        with BaseEvent.db.unit_of_work():
+            events = cls._parse_calendar_data(data)
+            fetched = {_event.id for _event in events}
+            for _id in BaseEvent.db.ids_in_range(
+                "CalendarEvent", "due", start / 1000, end / 1000
+            ):
+                if _id not in fetched:
+                    CalendarEvent.delete(id=_id)
+        if full:
+            BaseEvent.db.set_state("calendar_full_sync", now)
+        cls.last_sync = now
+        return events
+
+    @classmethod
+    def _get_calendar_json(cls, start, end) -> list[dict]:
         # timestamp in milliseconds
         params = {"start": start, "end": end, "course_id": "", "mode": "personal"}
-        r = self.login.get(
+        r = cls.login.get(
             "https://bb.cuhk.edu.cn/webapps/calendar/calendarData/selectedCalendarEvents",
             params=params,
         )
-        data = r.json()
+        return r.json()
+
+    def get_calendar_data_period(self, start, end) -> list[CalendarEvent]:
+        data = self._get_calendar_json(start, end)
         events = self._parse_calendar_data(data)
         return events
 
-    def get_calendar_data(self, counts=1, _type=MONTHS) -> list[CalendarEvent]:
-        import time
-
+    @staticmethod
+    def _period(counts=1, _type=MONTHS) -> tuple[int, int]:
         now = int(time.time() * 1000)
         if _type == MONTHS:
-            start = now - 1000 * 60 * 60 * 24 * 30 * counts
-            end = now + 1000 * 60 * 60 * 24 * 30 * counts
-            return self.get_calendar_data_period(start, end)
+            days = 30
         elif _type == WEEKS:
-            start = now - 1000 * 60 * 60 * 24 * 7 * counts
-            end = now + 1000 * 60 * 60 * 24 * 7 * counts
-            return self.get_calendar_data_period(start, end)
+            days = 7
         elif _type == DAYS:
-            start = now - 1000 * 60 * 60 * 24 * counts
-            end = now + 1000 * 60 * 60 * 24 * counts
-            return self.get_calendar_data_period(start, end)
+            days = 1
         elif _type == YEARS:
-            start = now - 1000 * 60 * 60 * 24 * 365 * counts
-            end = now + 1000 * 60 * 60 * 24 * 365 * counts
-            return self.get_calendar_data_period(start, end)
+            days = 365
         else:
             raise ValueError("type must be one of 'years', 'months', 'weeks', 'days'")
+        span = 1000 * 60 * 60 * 24 * days * counts
+        return now - span, now + span
+
+    def get_calendar_data(self, counts=1, _type=MONTHS) -> list[CalendarEvent]:
+        return self.get_calendar_data_period(*self._period(counts, _type))
 
     def get_ical_link(self) -> str:
         url = "https://bb.cuhk.edu.cn/webapps/calendar/calendarFeed/url"
         return self.login.get(url).text
 
 
+COURSE_LIST_TTL = timedelta(hours=int(os.getenv("BB_COURSE_TTL_HOURS", "24")))
+
+
 class CourseRetriever(BaseRetriever):
     login: Login
+    # Course list of this process and when it was fetched from Blackboard
     course_list: list[CourseEvent] = []
+    course_list_at = 0.0
 
     def retrieve(self, query: str) -> list[CourseEvent]:
         """
@@ -645,31 +2287,83 @@ class CourseRetriever(BaseRetriever):
         return self.get_course_list()
 
     @staticmethod
-    def get_course_list() -> list[CourseEvent]:
-        if CourseRetriever.course_list:
-            return CourseRetriever.course_list
-        r = CourseRetriever.login.get(
-            "https://bb.cuhk.edu.cn/webapps/portal/execute/tabs/tabAction?tab_tab_group_id"
-            "=_1_1"
+    def get_course_list(refresh=False) -> list[CourseEvent]:
+        """
+        The ids of the course list are kept in the state table, the portal tab is
+        only fetched again once they are older than BB_COURSE_TTL_HOURS, so that
+        courses joined or dropped show up within that bound.
+        :param refresh: fetch the portal tab now
+        """
+        state = BaseEvent.db.get_state("course_list")
+        expired = (
+            state is None
+            or time.time() - state["fetched_at"] >= COURSE_LIST_TTL.total_seconds()
         )
+        if not refresh and not expired:
+            if CourseRetriever.course_list_at == state["fetched_at"]:
+                return CourseRetriever.course_list
+            courses = CourseRetriever._load_course_list(state["ids"])
+            if courses is not None:
+                CourseRetriever._set_course_list(courses, state["fetched_at"])
+                return courses
+        try:
+            r = CourseRetriever.login.get(
+                "https://bb.cuhk.edu.cn/webapps/portal/execute/tabs/tabAction?tab_tab_group_id"
+                "=_1_1"
+            )
+            r.raise_for_status()
+        except Exception as e:
+            courses = CourseRetriever._load_course_list(state["ids"]) if state else None
+            if courses is None:
+                raise
+            print(f"Course list not available, using the stored one: {e}")
+            CourseRetriever._set_course_list(courses, state["fetched_at"])
+            return courses
         data = r.text
         courses = CourseRetriever._parse_course_data(data)
+        fetched_at = time.time()
+        BaseEvent.db.set_state(
+            "course_list",
+            {"fetched_at": fetched_at, "ids": [__course.id for __course in courses]},
+        )
+        CourseRetriever._set_course_list(courses, fetched_at)
+        return courses
+
+    @staticmethod
+    def _set_course_list(courses: list[CourseEvent], fetched_at: float):
         CourseRetriever.course_list = courses
+        CourseRetriever.course_list_at = fetched_at
+
+    @staticmethod
+    def _load_course_list(ids: list[str]) -> list[CourseEvent] | None:
+        """
+        :return: the stored courses, or None if any of them is missing
+        """
+        courses = []
+        for _id in ids:
+            stored = CourseEvent.filter(id=_id)
+            if not stored:
+                return None
+            courses.append(CourseRetriever._reuse(stored[0]))
         return courses
 
+    @staticmethod
+    def _reuse(_course: CourseEvent) -> CourseEvent:
+        _course.login = CourseRetriever.login
+        return _course
+
     @staticmethod
     def _parse_course_data(data: str) -> list[CourseEvent]:
         courses = []
-        for line in data.split("\n"):
-            if "type=Course" in line:
-                # <a href=" /webapps/blackboard/execute/launcher?type=Course&id=_10351_1&url="
-                # target="_top">CHI1000:Chinese_L13L14L15L16</a>
-                course_id = line.split("id=")[1].split("&")[0]
-                course_name = line.split(">")[1].split("<")[0]
-                __course = CourseEvent(
-                    course_id, course_name, _login=CourseRetriever.login
+        for course_id, course_name in extract_courses(data):
+            stored = CourseEvent.filter(id=course_id)
+            if stored and stored[0].title == course_name:
+                # Unchanged, no need to save it again
+                courses.append(CourseRetriever._reuse(stored[0]))
+            else:
+                courses.append(
+                    CourseEvent(course_id, course_name, _login=CourseRetriever.login)
                 )
-                courses.append(__course)
         return courses
 
     def get_course_by_title(self, title: str) -> CourseEvent | None:
@@ -686,6 +2380,9 @@ class CourseRetriever(BaseRetriever):
 
 
 class ContentRetriever(BaseRetriever):
+    courses_polled = 0
+    courses_quiet = 0
+
     def retrieve(self, query: str) -> list[ContentEvent]:
         return self.get_content_list()
 
@@ -696,28 +2393,82 @@ class ContentRetriever(BaseRetriever):
         if isinstance(courses, CourseEvent):
             courses = [courses]
         root_contents = []
-        for __course in tqdm(courses, desc="Retrieving Root Content"):
-            if __course.root_content_list:
-                root_contents.extend(__course.root_content_list)
-                continue
-            url = f"https://bb.cuhk.edu.cn/webapps/blackboard/execute/modulepage/view?course_id={__course.id}"
-            r = cls.login.get(url=url)
-            data = r.text
-            # print(data)
-            root_contents.extend(cls.parse_content_data(data, __course))
-
+        for __course, _roots in fan_out(
+            cls._get_root_contents,
+            courses,
+            "Retrieving Root Content",
+            cls._get_stored_root_contents,
+        ):
+            root_contents.extend(_roots)
         return root_contents
 
+    @classmethod
+    def _get_root_contents(cls, _course: CourseEvent) -> list[ContentListEvent]:
+        url = f"https://bb.cuhk.edu.cn/webapps/blackboard/execute/modulepage/view?course_id={_course.id}"
+        r = cls.login.get(url=url)
+        r.raise_for_status()
+        data = r.text
+        # print(data)
+        return cls.parse_content_data(data, _course)
+
+    @staticmethod
+    def _get_stored_root_contents(_course: CourseEvent) -> list[ContentListEvent]:
+        """
+        Root folders of a course from the last run, settled so that the crawler
+        reuses their stored subtrees without requesting the course again
+        """
+        roots = ContentListEvent.filter(course_id=_course.id, parent_id=None)
+        for root in roots:
+            root.settled = True
+        return roots
+
     @classmethod
     def get_content_list_by_course(
         cls, courses: CourseEvent | list[CourseEvent]
     ) -> list[ContentEvent]:
-        root_contents = cls.get_root_content_list_by_course(courses)
+        return list(cls.iter_content_list_by_course(courses))
 
-        _all = []
-        for root_content in tqdm(root_contents, desc="Retrieving Full Content"):
-            _all.extend(root_content.get_all_contents())
-        return _all
+    @classmethod
+    def iter_content_list_by_course(cls, courses: CourseEvent | list[CourseEvent]):
+        """
+        Crawl the courses that are due in COURSE_SCHEDULE, the stored contents of
+        the other courses are reused without any request. Each poll is recorded
+        with the digest of the roots of the course.
+        """
+        if isinstance(courses, CourseEvent):
+            courses = [courses]
+        polled = [
+            __course
+            for __course in courses
+            if COURSE_SCHEDULE.is_due(
+                __course.id, ContentCrawler.is_boosted(__course.id)
+            )
+        ]
+        polled_ids = {__course.id for __course in polled}
+        started = time.time()
+        root_contents = cls.get_root_content_list_by_course(polled)
+        for __course in courses:
+            if __course.id not in polled_ids:
+                root_contents.extend(cls._get_stored_root_contents(__course))
+        ContentRetriever.courses_polled += len(polled)
+        ContentRetriever.courses_quiet += len(courses) - len(polled)
+
+        yield from ContentCrawler().iter_crawl(root_contents)
+
+        for __course in polled:
+            roots = [root for root in root_contents if root.course.id == __course.id]
+            if any(root.settled for root in roots):
+                # The course failed and fell back to its stored roots
+                continue
+            digest = hashlib.sha1(
+                json.dumps(sorted((root.id, root.digest) for root in roots)).encode()
+            ).hexdigest()
+            COURSE_SCHEDULE.record(
+                __course.id,
+                digest,
+                ContentCrawler.is_boosted(__course.id),
+                polled_at=started,
+            )
 
     @classmethod
     def get_content_list(cls) -> list[ContentEvent]:
@@ -727,28 +2478,12 @@ class ContentRetriever(BaseRetriever):
 
     @staticmethod
     def parse_content_data(data: str, _course: CourseEvent) -> list[ContentListEvent]:
-        root_contents = []
-        # etree parse html, li element with href contains "content_id"
-        html = etree.HTML(data)
-        _li_list = html.xpath("//li")
-        if len(_li_list) <= 0:
-            return []
-        for element in _li_list:
-            href = element.xpath("a")
-            if len(href) <= 0:
-                continue
-            href_str = href[0].get("href")
-            if href and "content_id" in href_str:
-                content_id = href_str.split("content_id=")[1].split("&")[0]
-                title = href[0].xpath("span/text()")[0]
-                __content = ContentListEvent(
-                    _course, content_id, title, path=_course.title + "/" + title
-                )
-                root_contents.append(__content)
-
-        # print(f'Get {len(root_contents)} Folders in {course.title}!')
-
-        return root_contents
+        return [
+            ContentListEvent(
+                _course, content_id, title, path=_course.title + "/" + title
+            )
+            for content_id, title in extract_modules(data)
+        ]
 
 
 class AssignmentRetriever(BaseRetriever):
@@ -770,6 +2505,44 @@ class AssignmentRetriever(BaseRetriever):
     def get_assignment_list(cls) -> list[AssignmentEvent]:
         return cls.get_assignment_list_by_course(CourseRetriever.get_course_list())
 
+    @classmethod
+    def refresh_assignment_list(cls) -> list[AssignmentEvent]:
+        """
+        Refresh the status and due date of the stored assignments without crawling
+        the content trees. The status of open assignments is always fetched, the
+        others follow the detail cache policy.
+        """
+        now = datetime.now(pytz.timezone("Asia/Shanghai"))
+
+        def refresh(assignment: AssignmentEvent) -> AssignmentEvent:
+            assignment.login = cls.login
+            metadata = assignment.metadata
+            if (
+                "fetched_at" in metadata
+                and not metadata["is_finished"]
+                and now - metadata["due"] <= AssignmentEvent.archive_after
+            ):
+                assignment._get_detail(metadata)
+                assignment.save()
+            else:
+                assignment.refresh_detail()
+            return assignment
+
+        with ThreadPoolExecutor(max_workers=CRAWL_CONCURRENCY) as executor:
+            return list(executor.map(refresh, AssignmentEvent.all()))
+
+
+ANNOUNCEMENT_FULL_VIEW = "2"
+# viewChoice of a view that only lists recent announcements, empty to always
+# fetch the full history
+ANNOUNCEMENT_RECENT_VIEW = os.getenv("BB_ANNOUNCEMENT_VIEW", "1")
+ANNOUNCEMENT_RECENT_SPAN = timedelta(
+    days=int(os.getenv("BB_ANNOUNCEMENT_VIEW_DAYS", "7"))
+)
+ANNOUNCEMENT_FULL_INTERVAL = timedelta(
+    hours=int(os.getenv("BB_ANNOUNCEMENT_FULL_HOURS", "24"))
+)
+
 
 class AnnouncementRetriever(BaseRetriever):
     def retrieve(self, query: str) -> list[AnnouncementEvent]:
@@ -779,59 +2552,84 @@ class AnnouncementRetriever(BaseRetriever):
     def get_announcement_list_by_course(
         cls, courses: CourseEvent | list[CourseEvent]
     ) -> list[AnnouncementEvent]:
+        return list(cls.iter_announcement_list_by_course(courses))
+
+    @classmethod
+    def iter_announcement_list_by_course(cls, courses: CourseEvent | list[CourseEvent]):
+        """
+        Yield the announcements of each course as soon as its page is parsed.
+        Only announcements that are not stored for the course yet are parsed,
+        the others are read from the database. The recent view is used while the
+        last sync is within its span, the full history every
+        BB_ANNOUNCEMENT_FULL_HOURS to pick up edits and deletions.
+        """
         if isinstance(courses, CourseEvent):
             courses = [courses]
-        _all_announcements = []
-        for __course in courses:
-            url = (
-                f"https://bb.cuhk.edu.cn/webapps/blackboard/execute/announcement?"
-                f"method=search&context=mybb&course_id={__course.id}&viewChoice=2"
-            )
-            r = AnnouncementRetriever.login.get(url=url)
-            data = r.text
-            # print(data)
-            _all_announcements.extend(cls._parse_announcement_data(data, __course))
-        return _all_announcements
+        for __course, announcements in fan_out(
+            cls._sync_course,
+            courses,
+            "Retrieving Announcements",
+            cls._get_stored_announcements,
+        ):
+            yield from announcements
+
+    @staticmethod
+    def _get_stored_announcements(_course: CourseEvent) -> list[AnnouncementEvent]:
+        return AnnouncementEvent.filter(course_id=_course.id)
 
     @classmethod
-    def get_announcement_list(cls) -> list[AnnouncementEvent]:
-        courses = CourseRetriever.get_course_list()
-        announcements = []
-        for __course in tqdm(courses, "Retrieving Announcements"):
-            announcements += AnnouncementRetriever.get_announcement_list_by_course(
-                __course
+    def _sync_course(cls, _course: CourseEvent) -> list[AnnouncementEvent]:
+        now = time.time()
+        key = f"announcements:{_course.id}"
+        state = BaseEvent.db.get_state(key)
+        full = (
+            state is None
+            or not ANNOUNCEMENT_RECENT_VIEW
+            or now - state["full_at"] >= ANNOUNCEMENT_FULL_INTERVAL.total_seconds()
+            or now - state["synced_at"] >= ANNOUNCEMENT_RECENT_SPAN.total_seconds()
+        )
+        if not full:
+            r = cls._get_announcement_page(_course, ANNOUNCEMENT_RECENT_VIEW)
+            if r.status_code != 200:
+                # The recent view is not supported, fall back to the full history
+                full = True
+        if full:
+            r = cls._get_announcement_page(_course, ANNOUNCEMENT_FULL_VIEW)
+            r.raise_for_status()
+            announcements = cls._parse_announcement_data(r.text, _course)
+            state = {"synced_at": now, "full_at": now}
+        else:
+            stored = cls._get_stored_announcements(_course)
+            announcements = cls._parse_announcement_data(
+                r.text, _course, known={_a.id for _a in stored}
             )
+            state["synced_at"] = now
+            announcements += stored
+        BaseEvent.db.set_state(key, state)
         return announcements
 
+    @classmethod
+    def _get_announcement_page(cls, _course: CourseEvent, view: str):
+        url = (
+            f"https://bb.cuhk.edu.cn/webapps/blackboard/execute/announcement?"
+            f"method=search&context=mybb&course_id={_course.id}&viewChoice={view}"
+        )
+        return AnnouncementRetriever.login.get(url=url)
+
+    @classmethod
+    def get_announcement_list(cls) -> list[AnnouncementEvent]:
+        return cls.get_announcement_list_by_course(CourseRetriever.get_course_list())
+
     @classmethod
     def _parse_announcement_data(
-        cls, data: str, _course: CourseEvent
+        cls, data: str, _course: CourseEvent, known: set[str] | None = None
     ) -> list[AnnouncementEvent]:
-        announcements = []
-        # etree parse html, li element with href contains "content_id"
-        html = etree.HTML(data)
-        ul_list = html.xpath('//*[@id="announcementList"]')
-        if len(ul_list) <= 0:
-            return []
-        for element in ul_list[0].xpath("//li"):
-            _id = element.xpath("@id")
-            if _id and _id[0].startswith("_"):
-                # <a href="/webapps/blackboard/content/listContent.jsp?
-                # course_id=_11467_1&content_id=_123237_1&mode=reset"
-                # target="_top">Assignment 1</a>
-                announcement_id = _id[0]
-                title = element.xpath("h3/text()")[0]
-
-                raw_detail = element.xpath("string(.)").strip().split("\n")
-                raw_detail = [x.strip() for x in raw_detail if x.strip()]
-                detail = "\n".join(raw_detail[1:])
-
-                __announcement = AnnouncementEvent(
-                    _course, announcement_id, title, metadata={"detail": detail}
-                )
-                announcements.append(__announcement)
-
-        return announcements
+        return [
+            AnnouncementEvent(
+                _course, announcement_id, title, metadata={"detail": detail}
+            )
+            for announcement_id, title, detail in extract_announcements(data, known)
+        ]
 
 
 """
@@ -1247,159 +3045,384 @@ def notify_email(
     NotifyRecord.create(template_name, receiver)
 
 
-def compare_data(
-    db_data: list[BaseEvent], current_data: list[BaseEvent]
-) -> tuple[list[BaseEvent], list[BaseEvent]]:
-    new_data = []
-    removed_data = []
+# Offsets before the due date of the unfinished assignment reminders, in minutes
+REMINDER_OFFSETS = [
+    timedelta(minutes=int(minutes))
+    for minutes in os.getenv("BB_REMINDER_OFFSETS", "1440,120,30").split(",")
+]
+
+
+class DeadlineTimers:
+    """
+    Unfinished assignment reminders at REMINDER_OFFSETS before the due dates.
+    A heap of (fire_at, assignment_id, due, offset) is loaded once from the
+    stored due dates and kept up to date with update, entries of an outdated
+    due date are dropped when they are popped. Reminders sent are kept in the
+    state table so they are not sent again by another run, reminders whose email
+    failed are pushed back and tried again after retry_delay.
+    """
+
+    retry_delay = 300
+
+    def __init__(self, offsets=None):
+        self.offsets = [
+            offset.total_seconds() for offset in (offsets or REMINDER_OFFSETS)
+        ]
+        self.heap = []
+        # assignment id -> the due timestamp its reminders are scheduled for
+        self.scheduled: dict[str, float] = {}
+        self.loaded = False
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        for assignment in AssignmentEvent.all():
+            self.update(assignment)
+
+    def update(self, assignment: AssignmentEvent):
+        """
+        Schedule the reminders of an assignment again after its due date or its
+        status changed
+        """
+        if not self.loaded:
+            # load picks up the assignment from the database
+            return
+        if "due" not in assignment.metadata or assignment.is_finished():
+            self.scheduled.pop(assignment.id, None)
+            return
+        due = assignment.get_due().timestamp()
+        if self.scheduled.get(assignment.id) == due:
+            return
+        self.scheduled[assignment.id] = due
+        sent = self._sent().get(assignment.id)
+        sent_offsets = sent[1] if sent and sent[0] == due else []
+        for offset in self.offsets:
+            if offset not in sent_offsets:
+                heapq.heappush(self.heap, (due - offset, assignment.id, due, offset))
+
+    def discard(self, assignment_id: str):
+        self.scheduled.pop(assignment_id, None)
+
+    def next_fire(self) -> float | None:
+        """
+        :return: timestamp of the next reminder, None if there is none
+        """
+        self.load()
+        while self.heap and self.scheduled.get(self.heap[0][1]) != self.heap[0][2]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def fire(self, now: float | None = None) -> list[AssignmentEvent]:
+        """
+        Send the reminders that are due. Reminders of one assignment that were
+        missed together, e.g. while the process was down, are sent as one email.
+        :return: the assignments reminded
+        """
+        self.load()
+        now = now or time.time()
+        fired: dict[str, list[float]] = {}
+        while self.heap and self.heap[0][0] <= now:
+            _, assignment_id, due, offset = heapq.heappop(self.heap)
+            if self.scheduled.get(assignment_id) == due:
+                fired.setdefault(assignment_id, []).append(offset)
+        if not fired:
+            return []
+
+        sent = self._sent()
+        reminded = []
+        for assignment_id, offsets in fired.items():
+            due = self.scheduled[assignment_id]
+            previous = sent.get(assignment_id)
+            if previous and previous[0] == due:
+                # Another run may have sent some of them already
+                offsets = [offset for offset in offsets if offset not in previous[1]]
+                if not offsets:
+                    continue
+            if due > now:
+                _found = AssignmentEvent.filter(id=assignment_id)
+                if _found and not _found[0].is_finished():
+                    try:
+                        notify_email("unfinished_assignments", _found[0])
+                    except Exception as e:
+                        print(f"Reminder of {_found[0]} failed, retrying: {e}")
+                        for offset in offsets:
+                            heapq.heappush(
+                                self.heap,
+                                (now + self.retry_delay, assignment_id, due, offset),
+                            )
+                        continue
+                    reminded.append(_found[0])
+            if previous and previous[0] == due:
+                offsets = previous[1] + offsets
+            sent[assignment_id] = [due, offsets]
+        # Reminders of past due dates are not needed any more
+        sent = {_id: value for _id, value in sent.items() if value[0] > now}
+        BaseEvent.db.set_state("reminders_sent", sent)
+        return reminded
+
+    @staticmethod
+    def _sent() -> dict[str, list]:
+        """
+        :return: assignment id -> [due timestamp, offsets reminded]
+        """
+        return BaseEvent.db.get_state("reminders_sent", {})
+
+
+DEADLINES = DeadlineTimers()
+
+
+class Changeset:
+    added: list[BaseEvent]
+    removed: list[BaseEvent]
+    modified: list[BaseEvent]
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.modified = []
+
+    def events(self, kind: str) -> list[BaseEvent]:
+        if kind == "new":
+            return self.added
+        elif kind == "modified":
+            return self.modified
+        elif kind == "removed":
+            return self.removed
+        raise ValueError("kind must be one of 'new', 'modified', 'removed'")
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.modified)
+
+
+class DiffEngine:
+    """
+    Compare stored and current events through id -> fingerprint maps.
+    Current events are fed one by one as the retrievers yield them, every lookup is
+    O(1) so a whole diff is a single linear pass over both sides. Only the removed
+    events are ever loaded from the database.
+    """
+
+    def __init__(self, fingerprints: dict[tuple[str, str], str]):
+        # (event_type, id) -> fingerprint
+        self.fingerprints = fingerprints
+        self.stored = {_id: event_type for event_type, _id in fingerprints}
+        self.seen = set()
+        self.changeset = Changeset()
+
+    @classmethod
+    def from_database(cls, *event_types: str) -> "DiffEngine":
+        fingerprints = {}
+        for event_type in event_types:
+            for _id, fingerprint in BaseEvent.db.fingerprints(event_type).items():
+                fingerprints[(event_type, _id)] = fingerprint
+        return cls(fingerprints)
+
+    @classmethod
+    def from_events(cls, db_data: list[BaseEvent]) -> "DiffEngine":
+        return cls(
+            {(data.__class__.__name__, data.id): data.fingerprint() for data in db_data}
+        )
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def feed(self, data: BaseEvent) -> str | None:
+        """
+        :return: "new" or "modified" if the event changed, None otherwise
+        """
+        if data.id in self.seen:
+            return None
+        self.seen.add(data.id)
+        if data.id not in self.stored:
+            self.changeset.added.append(data)
+            return "new"
+        key = (self.stored[data.id], data.id)
+        if self.fingerprints[key] != data.fingerprint():
+            self.changeset.modified.append(data)
+            return "modified"
+        return None
+
+    def result(self) -> Changeset:
+        self.changeset.removed = [
+            BaseEvent.db.get_event(event_type, id=_id)
+            for _id, event_type in self.stored.items()
+            if _id not in self.seen
+        ]
+        return self.changeset
+
+
+def diff_events(db_data: list[BaseEvent], current_data: list[BaseEvent]) -> Changeset:
+    engine = DiffEngine.from_events(db_data)
     for data in current_data:
-        if not (data.id in [db_data.id for db_data in db_data]):
-            new_data.append(data)
-    for data in db_data:
-        if not (data.id in [current_data.id for current_data in current_data]):
-            removed_data.append(data)
-    return new_data, removed_data
+        engine.feed(data)
+    return engine.result()
 
 
 def print_compare_data(
-    contents, assignments, announcements, courses, update_or_remove: str
+    contents: Changeset,
+    assignments: Changeset,
+    announcements: Changeset,
+    courses: Changeset,
 ):
-    (
-        print(f"{len(contents)} {update_or_remove} contents found:")
-        if len(contents) > 0
-        else None
-    )
-    for __content in contents:
-        print("    " + str(__content))
-    (
-        print(f"{len(assignments)} {update_or_remove} assignments found:")
-        if len(assignments) > 0
-        else None
-    )
-    for __assignment in assignments:
-        print("    " + str(__assignment))
-    (
-        print(f"{len(announcements)} {update_or_remove} announcements found:")
-        if len(announcements) > 0
-        else None
-    )
-    for __announcement in announcements:
-        print("    " + str(__announcement))
-    (
-        print(f"{len(courses)} {update_or_remove} courses found:")
-        if len(courses) > 0
-        else None
-    )
-    for __course in courses:
-        print("    " + str(__course))
-    (
-        print(f"No {update_or_remove} content found.")
-        if len(courses + contents + assignments + announcements) <= 0
-        else None
-    )
+    for kind in ("new", "modified", "removed"):
+        found = False
+        for name, changeset in (
+            ("contents", contents),
+            ("assignments", assignments),
+            ("announcements", announcements),
+            ("courses", courses),
+        ):
+            events = changeset.events(kind)
+            if len(events) <= 0:
+                continue
+            found = True
+            print(f"{len(events)} {kind} {name} found:")
+            for __event in events:
+                print("    " + str(__event))
+        if not found:
+            print(f"No {kind} content found.")
 
 
-def main():
+def reset_cycle_stats():
+    ContentListEvent.page_cache.hits = 0
+    ContentListEvent.page_cache.misses = 0
+    ContentCrawler.skipped_folders = 0
+    AssignmentEvent.detail_fetches = 0
+    AssignmentEvent.detail_cache_hits = 0
+    AssignmentEvent.due_dates = DueDateResolver()
+    ContentCrawler.stage_stats = []
+    ContentCrawler.boosted_courses = None
+    ContentRetriever.courses_polled = 0
+    ContentRetriever.courses_quiet = 0
+    BaseEvent.db.commit_count = 0
+
+
+# Data sources a cycle can poll
+SOURCES = ("courses", "announcements", "assignments", "contents")
+
+
+def run_cycle(login: Login, sources=SOURCES, refresh_courses=False):
+    """
+    One poll of Blackboard: retrieve, compare with the DataBase and notify.
+    Can be called repeatedly in one process, the session, database connections,
+    page cache and course list are kept between calls.
+    :param sources: the SOURCES to poll. "courses" compares the course list,
+        "assignments" refreshes the stored assignments and "contents" crawls the
+        content trees, which refreshes the assignments as well.
+    :param refresh_courses: fetch the course tab even if the stored course list
+        is within BB_COURSE_TTL_HOURS, for the daemon's courses interval
+    """
     disable_email = False
-    login = BBLogin(os.getenv("BB_USERNAME"), os.getenv("BB_PASSWORD"))
+    reset_cycle_stats()
+    # The worker threads of the last cycle are gone, so are their connections
+    BaseEvent.db.connections.prune()
 
     # Reading Data from DataBase
+    # Only the sources polled are compared, the others have no changes
     print("Reading Data from DataBase...", end=" ")
-    db_all_contents = ContentEvent.all() + FileEvent.all()
-    db_all_assignments = AssignmentEvent.all()
-    db_all_announcements = AnnouncementEvent.all()
-    db_all_courses = CourseEvent.all()
+    polled = {"courses": DiffEngine.from_database("CourseEvent")}
+    if "contents" in sources:
+        polled["contents"] = DiffEngine.from_database("ContentEvent", "FileEvent")
+    if "contents" in sources or "assignments" in sources:
+        polled["assignments"] = DiffEngine.from_database("AssignmentEvent")
+    if "announcements" in sources:
+        polled["announcements"] = DiffEngine.from_database("AnnouncementEvent")
+    content_engine = polled.get("contents", DiffEngine({}))
+    assignment_engine = polled.get("assignments", DiffEngine({}))
+    announcement_engine = polled.get("announcements", DiffEngine({}))
+    course_engine = polled["courses"]
     print("  Done!")
     print(
-        f"DataBase has {len(db_all_contents)} contents, {len(db_all_assignments)} assignments, "
-        f"{len(db_all_announcements)} announcements, and {len(db_all_courses)} courses."
+        "DataBase has "
+        + ", ".join(f"{len(engine)} {name}" for name, engine in polled.items())
+        + "."
     )
 
-    if len(db_all_contents) <= 0:
+    if "contents" in sources:
+        stored_contents = len(content_engine)
+    else:
+        stored_contents = BaseEvent.db.count_events("ContentEvent", "FileEvent")
+    if stored_contents <= 0:
         print("No data in DataBase, retrieving all data from Blackboard...")
         print("Disabling Email Notification...")
         disable_email = True
 
-    # Retrieving Data from Blackboard
+    # Retrieving Data from Blackboard, every event is compared with the DataBase
+    # and notified as soon as it is retrieved
+    BaseEvent.init(login)
     CourseRetriever.init(login)
     ContentRetriever.init(login)
     AssignmentRetriever.init(login)
     AnnouncementRetriever.init(login)
-    print("Retrieving Data from Blackboard...", end=" ")
-    all_contents = ContentRetriever.get_content_list()
-    all_contents = [
-        content for content in all_contents if not isinstance(content, AssignmentEvent)
-    ]
-    print(f"  {len(all_contents)} contents retrieved.")
-    all_assignments = AssignmentRetriever.get_assignment_list()
-    print(f"  {len(all_assignments)} assignments retrieved.")
-    all_announcements = AnnouncementRetriever.get_announcement_list()
-    print(f"  {len(all_announcements)} announcements retrieved.")
-    all_courses = CourseRetriever.get_course_list()
+    CalendarRetriever.init(login)
+    print("Retrieving Data from Blackboard...")
+    with BaseEvent.db.unit_of_work():
+        all_courses = CourseRetriever.get_course_list(refresh=refresh_courses)
+        for course in all_courses:
+            course_engine.feed(course)
     print(f"  {len(all_courses)} courses retrieved.")
 
-    # Comparing Data from Blackboard and DataBase
-    db_all_contents = cast(list[ContentEvent], db_all_contents)
-    db_all_assignments = cast(list[AssignmentEvent], db_all_assignments)
-    db_all_announcements = cast(list[AnnouncementEvent], db_all_announcements)
-    db_all_courses = cast(list[CourseEvent], db_all_courses)
-
-    new_contents, removed_contents = compare_data(db_all_contents, all_contents)
-    new_assignments, removed_assignments = compare_data(
-        db_all_assignments, all_assignments
-    )
-    new_announcements, removed_announcements = compare_data(
-        db_all_announcements, all_announcements
-    )
-    new_courses, removed_courses = compare_data(db_all_courses, all_courses)
-    print("  Done!")
+    if "announcements" in sources:
+        with BaseEvent.db.unit_of_work():
+            for announcement in AnnouncementRetriever.iter_announcement_list_by_course(
+                all_courses
+            ):
+                if (
+                    announcement_engine.feed(announcement) == "new"
+                    and not disable_email
+                ):
+                    notify_email("new_announcements", announcement)
+        print(f"  {len(announcement_engine.seen)} announcements retrieved.")
+
+    if "contents" in sources:
+        all_assignments = []
+        with BaseEvent.db.unit_of_work():
+            for content in ContentRetriever.iter_content_list_by_course(all_courses):
+                if not isinstance(content, AssignmentEvent):
+                    content_engine.feed(content)
+                    continue
+                all_assignments.append(content)
+                if assignment_engine.feed(content) == "new" and not disable_email:
+                    notify_email("new_assignments", content)
+        print(f"  {len(content_engine.seen)} contents retrieved.")
+        print(f"  {len(all_assignments)} assignments retrieved.")
+    elif "assignments" in sources:
+        with BaseEvent.db.unit_of_work():
+            all_assignments = AssignmentRetriever.refresh_assignment_list()
+        for assignment in all_assignments:
+            assignment_engine.feed(assignment)
+        print(f"  {len(all_assignments)} assignments refreshed.")
+
+    content_changes = content_engine.result()
+    assignment_changes = assignment_engine.result()
+    announcement_changes = announcement_engine.result()
+    course_changes = course_engine.result()
 
     # Printing Data
     print_compare_data(
-        new_contents, new_assignments, new_announcements, new_courses, "new"
-    )
-    print_compare_data(
-        removed_contents,
-        removed_assignments,
-        removed_announcements,
-        removed_courses,
-        "removed",
+        content_changes, assignment_changes, announcement_changes, course_changes
     )
 
     # Deleting Removed Data
-    for _content in removed_contents:
-        _content.delete_self()
-    for _assignment in removed_assignments:
-        _assignment.delete_self()
-    for _announcement in removed_announcements:
-        _announcement.delete_self()
-    for _course in removed_courses:
-        _course.delete_self()
+    for changeset in (
+        content_changes,
+        assignment_changes,
+        announcement_changes,
+        course_changes,
+    ):
+        for _event in changeset.removed:
+            _event.delete_self()
+
+    for assignment in assignment_changes.added + assignment_changes.modified:
+        DEADLINES.update(assignment)
+    for assignment in assignment_changes.removed:
+        DEADLINES.discard(assignment.id)
 
     if disable_email:
         print("Email Notification Disabled!")
-        exit(0)
-    # Sending Notification Email
-    for content in new_contents:
-        # notify_email("new_content", content)
-        pass
-    for assignment in new_assignments:
-        assignment = cast(AssignmentEvent, assignment)
-        notify_email("new_assignments", assignment)
-    for announcement in new_announcements:
-        announcement = cast(AnnouncementEvent, announcement)
-        notify_email("new_announcements", announcement)
-    for assignment in all_assignments:
-        assignment = cast(AssignmentEvent, assignment)
-        if (
-            assignment.get_due()
-            - pytz.timezone("Asia/Shanghai").localize(datetime.now())
-        ) <= timedelta(hours=2):
-            (
-                notify_email("unfinished_assignments", assignment)
-                if not assignment.is_finished()
-                else None
-            )
+        return
+    DEADLINES.fire()
 
     # Daily Summary
     all_notify_record = NotifyRecord.all()
@@ -1422,10 +3445,108 @@ def main():
         assignments = [cast(AssignmentEvent, assignment) for assignment in assignments]
         notify_email("daily_summary", assignments)
 
+    print(f"HTTP: {login.stats()}")
+    print(
+        f"Page cache: {ContentListEvent.page_cache.hits} unchanged, "
+        f"{ContentListEvent.page_cache.misses} parsed, "
+        f"{ContentCrawler.skipped_folders} folders skipped"
+    )
+    if ContentRetriever.courses_polled or ContentRetriever.courses_quiet:
+        print(
+            f"Course polling: {ContentRetriever.courses_polled} polled, "
+            f"{ContentRetriever.courses_quiet} quiet"
+        )
+    print(
+        f"Assignment detail: {AssignmentEvent.detail_fetches} fetched, "
+        f"{AssignmentEvent.detail_cache_hits} cached, "
+        f"{AssignmentEvent.due_dates.hits} due dates from calendar"
+    )
+    if ContentCrawler.stage_stats:
+        print(f"Crawler stages: {ContentCrawler.stats()}")
+    print(f"Database: {BaseEvent.db.commit_count} commits")
     print("All Done!")
 
 
-if __name__ == "__main__":
+RUN_LOCK_PATH = "./persist/run.lock"
+# What a run does while another run holds the lock: "skip" or "queue" behind it
+RUN_OVERLAP = os.getenv("NOTIFY_OVERLAP", "skip")
+
+
+class RunLock:
+    """
+    Exclusive lock of a run, so that e.g. a manual run and the scheduler do not
+    crawl and write events.db and notify_record.csv at the same time.
+    An flock on RUN_LOCK_PATH, released by the OS if the holder dies. The file
+    holds the pid and start time of the holder.
+    """
+
+    def __init__(self, path=RUN_LOCK_PATH):
+        self.path = path
+        self.file = None
+
+    def acquire(self, wait=False) -> bool:
+        """
+        :param wait: block until the lock is free instead of giving up
+        :return: whether the lock is held
+        """
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "a+")
+        try:
+            fcntl.flock(
+                self.file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            return False
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(f"{os.getpid()} {datetime.now().isoformat()}\n")
+        self.file.flush()
+        return True
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def holder(self) -> str:
+        """
+        :return: "<pid> <start time>" of the run holding the lock
+        """
+        try:
+            with open(self.path, "r") as f:
+                return f.read().strip()
+        except OSError:
+            return "unknown"
+
+    @contextmanager
+    def hold(self, wait=False):
+        """
+        Yield whether the lock was acquired, release it on exit
+        """
+        acquired = self.acquire(wait)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release()
+
+
+def main():
+    lock = RunLock()
+    with lock.hold(wait=RUN_OVERLAP == "queue") as acquired:
+        if not acquired:
+            print(f"Another run is in progress ({lock.holder()}), skipped.")
+            return
+        login = BBLogin(os.getenv("BB_USERNAME"), os.getenv("BB_PASSWORD"))
+        run_cycle(login)
+
+
+def cli():
     try:
         main()
     except Exception as e:
@@ -1434,3 +3555,11 @@ if __name__ == "__main__":
         error_msg = traceback.format_exc()
         notify_email("error", error_msg + "\n\n" + str(e))
         exit(1)
+
+
+if __name__ == "__main__":
+    # Run as the notify module, the same one the daemon imports, so the events
+    # are pickled as notify.* either way and isinstance checks hold across runs
+    import notify
+
+    notify.cli()
@@ -1,9 +1,122 @@
 import os
+import sys
 import time
+import heapq
+import random
 import subprocess
+import traceback
+from collections import deque
+from contextlib import redirect_stdout
 from datetime import datetime, timedelta
 import pytz
 
+class Tee:
+    """同时写入多个输出流，每次写入后立即刷新，日志不必等到执行结束"""
+
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+            stream.flush()
+        return len(data)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+# 每次执行前的随机延迟上限，单位：秒，避免总在整点同时请求
+JITTER_SECONDS = int(os.getenv('NOTIFY_JITTER', '30'))
+# 作业提醒未能发送（另一个运行持有锁或出错）时，隔多久再试，单位：秒
+REMINDER_RETRY_SECONDS = 60
+
+class RunStats:
+    """最近若干次执行的耗时统计，执行耗时超过间隔时给出警告"""
+
+    def __init__(self, size=20):
+        self.durations = deque(maxlen=size)
+
+    def record(self, duration, interval):
+        """记录一次执行的耗时，interval为本次执行中最短的轮询间隔"""
+        self.durations.append(duration)
+        mean = sum(self.durations) / len(self.durations)
+        print(f'执行耗时 {duration:.1f} 秒，最近 {len(self.durations)} 次平均 {mean:.1f} 秒，最长 {max(self.durations):.1f} 秒')
+        if duration >= interval.total_seconds():
+            print(f'警告: 执行耗时超过了间隔 {int(interval.total_seconds() // 60)} 分钟，期间错过的执行已合并为一次，请调大间隔')
+
+class Daemon:
+    """在同一进程中反复执行notify，登录会话、数据库连接、页面缓存和课程列表在各次执行之间保留"""
+
+    def __init__(self):
+        # 只有守护模式需要在本进程中导入notify
+        import notify
+        self.notify = notify
+        self.login = None
+        self.lock = notify.RunLock()
+
+    def run_cycle(self, sources=None):
+        """
+        执行一次notify，输出实时写入控制台和日志文件，sources为本次轮询的数据源，默认全部。
+        另一个运行（如手动执行的notify.py）持有运行锁时，按NOTIFY_OVERLAP跳过或排队等待。
+        返回是否执行了。
+        """
+        sources = sources or self.notify.SOURCES
+        log_name = datetime.now(pytz.timezone("Asia/Shanghai")).strftime("%Y-%m-%d %H-%M-%S") + ".log"
+        log_dir = os.path.join(os.path.dirname(__file__), "logs")
+        os.makedirs(log_dir, exist_ok=True)
+        log_path = os.path.join(log_dir, log_name)
+        with open(log_path, 'a', encoding='utf-8') as f, redirect_stdout(Tee(sys.stdout, f)):
+            current_time = datetime.now(pytz.timezone('Asia/Shanghai')).strftime('%Y-%m-%d %H-%M-%S')
+            print(f'[{current_time}] 开始执行: {", ".join(sources)}')
+            try:
+                with self.lock.hold(wait=self.notify.RUN_OVERLAP == 'queue') as acquired:
+                    if not acquired:
+                        print(f'另一个运行正在进行 ({self.lock.holder()})，跳过本次执行')
+                        return False
+                    if self.login is None:
+                        self.login = self.notify.BBLogin(os.getenv("BB_USERNAME"), os.getenv("BB_PASSWORD"))
+                    else:
+                        self.login.ensure_session()
+                    # 课程列表只在courses到期时强制刷新，其余执行按BB_COURSE_TTL_HOURS使用已保存的列表
+                    self.notify.run_cycle(self.login, sources, refresh_courses='courses' in sources)
+                print('执行成功')
+            except Exception as e:
+                error_msg = traceback.format_exc()
+                print(f'执行失败:\n{error_msg}')
+                try:
+                    self.notify.notify_email("error", error_msg + "\n\n" + str(e))
+                except Exception as mail_error:
+                    print(f'错误通知发送失败: {mail_error}')
+        return True
+    
+    def next_reminder(self):
+        """下一个作业截止提醒的时间，没有时返回None"""
+        try:
+            timestamp = self.notify.DEADLINES.next_fire()
+        except Exception:
+            print(f'读取作业提醒失败:\n{traceback.format_exc()}')
+            return None
+        if timestamp is None:
+            return None
+        return datetime.fromtimestamp(timestamp, pytz.timezone('Asia/Shanghai'))
+    
+    def fire_reminders(self):
+        """按时发送到期的作业截止提醒，不访问Blackboard。返回是否已处理到期的提醒"""
+        current_time = datetime.now(pytz.timezone('Asia/Shanghai')).strftime('%Y-%m-%d %H-%M-%S')
+        try:
+            # 另一个运行持有锁时不发送，它结束时会发送到期的提醒
+            with self.lock.hold() as acquired:
+                if not acquired:
+                    print(f'[{current_time}] 另一个运行正在进行，作业提醒稍后发送')
+                    return False
+                reminded = self.notify.DEADLINES.fire()
+            print(f'[{current_time}] 已发送 {len(reminded)} 个作业提醒')
+            return True
+        except Exception:
+            print(f'[{current_time}] 作业提醒发送失败:\n{traceback.format_exc()}')
+            return False
+
 def run_notify():
     """运行notify.py脚本并记录日志"""
     log_name = datetime.now(pytz.timezone("Asia/Shanghai")).strftime("%Y-%m-%d %H-%M-%S") + ".log"
@@ -63,7 +176,91 @@ def get_next_run_time(interval_minutes):
     next_run = now.replace(minute=next_minutes, second=0, microsecond=0)
     return next_run
 
+# 守护模式下各数据源的轮询间隔：(环境变量, 默认分钟数)
+SOURCE_INTERVALS = {
+    'announcements': ('NOTIFY_ANNOUNCEMENTS_INTERVAL', 5),
+    'assignments': ('NOTIFY_ASSIGNMENTS_INTERVAL', 15),
+    # 每门课程实际的抓取间隔由notify根据变化历史自适应决定
+    'contents': ('NOTIFY_CONTENTS_INTERVAL', 10),
+    'courses': ('NOTIFY_COURSES_INTERVAL', 1440),
+}
+
+def get_source_intervals():
+    """读取各数据源的轮询间隔"""
+    intervals = {}
+    for source, (env, default) in SOURCE_INTERVALS.items():
+        minutes = int(os.getenv(env, str(default)))
+        if minutes <= 0:
+            raise ValueError(f'{env} 必须为正整数')
+        intervals[source] = timedelta(minutes=minutes)
+    return intervals
+
+def run_daemon():
+    """
+    守护模式：每个数据源有各自的下次执行时间，放在优先队列中，同时到期的数据源合并为一次执行。
+    作业截止提醒有自己的时间表，在提醒时间准时发送，不等待下一次抓取。
+    """
+    intervals = get_source_intervals()
+    daemon = Daemon()
+    stats = RunStats()
+    tz = pytz.timezone('Asia/Shanghai')
+    
+    print('定时任务已启动，运行模式: daemon，轮询间隔: ' + ', '.join(
+        f'{source} {int(interval.total_seconds() // 60)} 分钟' for source, interval in intervals.items()))
+    
+    # 启动时所有数据源都立即执行一次
+    now = datetime.now(tz)
+    queue = [(now, source) for source in intervals]
+    heapq.heapify(queue)
+    # 到期的提醒未能发送时，在此时间之前不再尝试，避免反复空转
+    reminder_retry_at = None
+    
+    while True:
+        next_run, source = queue[0]
+        # 作业提醒准时发送，只有数据源的执行加随机延迟
+        next_run += timedelta(seconds=random.uniform(0, JITTER_SECONDS))
+        next_reminder = daemon.next_reminder()
+        if next_reminder is not None and reminder_retry_at is not None:
+            next_reminder = max(next_reminder, reminder_retry_at)
+        if next_reminder is not None and next_reminder < next_run:
+            next_run, source = next_reminder, '作业提醒'
+        wait_seconds = (next_run - datetime.now(tz)).total_seconds()
+        if wait_seconds > 0:
+            print(f'下次执行时间: {next_run.strftime("%Y-%m-%d %H:%M:%S")} ({source})')
+            time.sleep(wait_seconds)
+        
+        # 没有数据源到期时只发送作业提醒
+        now = datetime.now(tz)
+        if queue[0][0] > now:
+            if daemon.fire_reminders():
+                reminder_retry_at = None
+            else:
+                reminder_retry_at = now + timedelta(seconds=REMINDER_RETRY_SECONDS)
+            continue
+        
+        # 取出所有已到期的数据源
+        due = []
+        while queue and queue[0][0] <= now:
+            due.append(heapq.heappop(queue))
+        
+        started = time.monotonic()
+        if daemon.run_cycle([source for _, source in due]):
+            stats.record(time.monotonic() - started, min(intervals[source] for _, source in due))
+        
+        # 按计划时间推进，保持节奏不漂移；执行耗时超过间隔时错过的执行合并为一次，从当前时间重新计算
+        now = datetime.now(tz)
+        for scheduled, source in due:
+            heapq.heappush(queue, (max(scheduled + intervals[source], now), source))
+
 def main():
+    # daemon: 在本进程中执行（默认），各数据源按各自的间隔轮询；subprocess: 每次启动新的notify.py进程
+    mode = os.getenv('NOTIFY_MODE', 'daemon')
+    if mode not in ('daemon', 'subprocess'):
+        raise ValueError(f'未知的运行模式 {mode}，请使用 daemon 或 subprocess')
+    if mode == 'daemon':
+        run_daemon()
+        return
+    
     # 从环境变量获取间隔时间(分钟)，默认为30分钟
     interval_minutes = int(os.getenv('NOTIFY_INTERVAL', '30'))
     
@@ -71,7 +268,8 @@ def main():
     if 60 % interval_minutes != 0:
         raise ValueError(f'间隔时间 {interval_minutes} 分钟不是60的约数，请使用以下值：1, 2, 3, 4, 5, 6, 10, 12, 15, 20, 30, 60')
     
-    print(f'定时任务已启动，执行间隔: {interval_minutes} 分钟')
+    print(f'定时任务已启动，执行间隔: {interval_minutes} 分钟，运行模式: {mode}')
+    stats = RunStats()
     
     while True:
         # 计算下一个执行时间
@@ -83,9 +281,12 @@ def main():
         
         if wait_seconds > 0:
             print(f'下次执行时间: {next_run.strftime("%Y-%m-%d %H:%M:%S")}')
-            time.sleep(wait_seconds)
+            time.sleep(wait_seconds + random.uniform(0, JITTER_SECONDS))
         
+        # notify.py自己持有运行锁；执行超时错过的时间点不补执行，从结束时间计算下一个时间点
+        started = time.monotonic()
         run_notify()
+        stats.record(time.monotonic() - started, timedelta(minutes=interval_minutes))
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
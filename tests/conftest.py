@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import notify  # noqa: E402
+from fake_blackboard import FakeLogin, Site  # noqa: E402
+
+
+@pytest.fixture
+def open_database(tmp_path, monkeypatch):
+    """
+    Open an empty events.db under tmp_path/name and make it the database of the
+    events and the page cache
+    """
+    databases = []
+
+    def open_database(name="persist"):
+        db = notify.Database(str(tmp_path / name / "events.db"))
+        monkeypatch.setattr(notify.BaseEvent, "db", db)
+        monkeypatch.setattr(notify.ContentListEvent, "page_cache", notify.PageCache(db))
+        databases.append(db)
+        return db
+
+    yield open_database
+    for db in databases:
+        db.close()
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch, open_database):
+    """
+    An empty events.db under tmp_path/persist, with tmp_path as the working
+    directory so the other ./persist files land there too
+    """
+    monkeypatch.chdir(tmp_path)
+    return open_database()
+
+
+@pytest.fixture
+def emails(monkeypatch):
+    """
+    (template_name, obj) of every email sent
+    """
+    sent = []
+    monkeypatch.setattr(
+        notify, "notify_email", lambda name, obj, *args: sent.append((name, obj))
+    )
+    return sent
+
+
+@pytest.fixture
+def site():
+    return Site()
+
+
+@pytest.fixture
+def login(db, site, emails, monkeypatch):
+    """
+    A login to site, with the state notify keeps across cycles of a process reset
+    """
+    monkeypatch.setattr(notify.CourseRetriever, "course_list", [])
+    monkeypatch.setattr(notify.CourseRetriever, "course_list_at", 0.0)
+    monkeypatch.setattr(notify.CalendarRetriever, "last_sync", 0.0)
+    monkeypatch.setattr(notify, "DEADLINES", notify.DeadlineTimers())
+    return FakeLogin(site)
@@ -0,0 +1,203 @@
+"""
+An in-memory Blackboard for tests that run whole cycles. The pages it serves
+have the markup of the fixtures in tests/fixtures, requests never leave the
+process and are counted by page type.
+"""
+
+import json
+import threading
+from collections import Counter
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.models import Response
+
+import notify
+
+BB = "https://bb.cuhk.edu.cn"
+
+CONTENT_ITEM = (
+    '<li id="contentListItem:{id}" class="clearfix liItem read">'
+    '<img src="https://bb.example.edu/images/ci/sets/set12/{type}_on.svg" class="item_icon">'
+    '<div class="item clearfix">{title}</div>'
+    '<div class="details"><div class="contextItemDetailsHeaders"></div>'
+    '<div class="vtbegenerated"><div><span>{detail}</span></div></div></div>'
+    "</li>"
+)
+LINKED_TITLE = (
+    '<h3><span class="hideoff">Item</span><a href="#"><span>{}</span></a></h3>'
+)
+SPAN_TITLE = '<h3><span class="hideoff">Item</span><span>{}</span></h3>'
+
+
+class Site:
+    """
+    courses, each with roots root folders nesting depth levels deep, fan sub
+    folders per folder. Every folder holds a document, an assignment and a file.
+    """
+
+    def __init__(self, courses=2, roots=1, depth=2, fan=2):
+        self.courses: dict[str, str] = {}
+        self.modules: dict[str, list[tuple[str, str]]] = {}
+        # folder id -> [(type, id, title)]
+        self.folders: dict[str, list[tuple[str, str, str]]] = {}
+        # course id -> [(id, title, detail)], in page order
+        self.announcements: dict[str, list[tuple[str, str, str]]] = {}
+        self.assignments: dict[str, dict] = {}
+        self.calendar: list[dict] = []
+        # content id -> status code or exception of its listing page
+        self.failures: dict[str, int | Exception] = {}
+        self.next_id = 400000
+        for _ in range(courses):
+            self.add_course(roots, depth, fan)
+
+    def add_course(self, roots=1, depth=2, fan=2) -> str:
+        number = len(self.courses)
+        course_id = f"_{10001 + number}_1"
+        self.courses[course_id] = f"ABC{1001 + number}:Course {number}"
+        self.modules[course_id] = [
+            (self.add_folder(1, depth, fan), f"Week {root}") for root in range(roots)
+        ]
+        self.announcements[course_id] = [
+            (self.new_id(), f"Announcement {i}", f"Detail {i}") for i in range(2)
+        ]
+        return course_id
+
+    def new_id(self) -> str:
+        self.next_id += 1
+        return f"_{self.next_id}_1"
+
+    def add_folder(self, level, depth, fan) -> str:
+        folder_id = self.new_id()
+        items = []
+        if level < depth:
+            for i in range(fan):
+                items.append(
+                    ("folder", self.add_folder(level + 1, depth, fan), f"Folder {i}")
+                )
+        items.append(("document", self.new_id(), f"Outline {level}"))
+        assignment_id = self.new_id()
+        items.append(("assignment", assignment_id, f"Homework {assignment_id}"))
+        self.assignments[assignment_id] = {"finished": False}
+        items.append(("file", self.new_id(), f"Lecture {level}.pdf"))
+        self.folders[folder_id] = items
+        return folder_id
+
+    def items(self, course_id) -> list[tuple[str, str, str]]:
+        """
+        (type, id, title) of every item in the content tree of the course
+        """
+        items = []
+        folders = [folder_id for folder_id, _ in self.modules[course_id]]
+        while folders:
+            for item in self.folders[folders.pop()]:
+                items.append(item)
+                if item[0] == "folder":
+                    folders.append(item[1])
+        return items
+
+    def page(self, path: str, query: dict) -> str:
+        if "tabAction" in path:
+            return "\n".join(
+                f'<a href=" /webapps/blackboard/execute/launcher?type=Course&id={_id}&url=" '
+                f'target="_top">{title}</a>'
+                for _id, title in self.courses.items()
+            )
+        if "modulepage/view" in path:
+            links = "".join(
+                f'<li><a href="/webapps/blackboard/content/listContent.jsp?'
+                f'course_id={query["course_id"]}&content_id={_id}&mode=reset">'
+                f"<span>{title}</span></a></li>"
+                for _id, title in self.modules[query["course_id"]]
+            )
+            return f"<html><body><ul>{links}</ul></body></html>"
+        if "listContent.jsp" in path:
+            items = "".join(
+                CONTENT_ITEM.format(
+                    id=_id,
+                    type=_type,
+                    title=(SPAN_TITLE if _type == "document" else LINKED_TITLE).format(
+                        title
+                    ),
+                    detail=f"About {title}",
+                )
+                for _type, _id, title in self.folders.get(query["content_id"], [])
+            )
+            return (
+                f'<html><body><ul id="content_listContainer">{items}</ul></body></html>'
+            )
+        if "uploadAssignment" in path:
+            if query.get("action") == "newAttempt":
+                return (
+                    '<html><body><div id="metadata"><div><div><div><div>Due</div>'
+                    "<div>Sunday, March 10, 2030 <span>11:59 PM</span></div>"
+                    '</div></div></div></div><div id="instructions">Answer all questions'
+                    "</div></body></html>"
+                )
+            finished = self.assignments[query["content_id"]]["finished"]
+            return (
+                "<html><body>"
+                + ("Review Submission" if finished else "Submit")
+                + "</body></html>"
+            )
+        if "announcement" in path:
+            items = "".join(
+                f'<li id="{_id}"><h3>{title}</h3>\n<div>{detail}</div></li>'
+                for _id, title, detail in self.announcements[query["course_id"]]
+            )
+            return f'<html><body><ul id="announcementList">{items}</ul></body></html>'
+        if "selectedCalendarEvents" in path:
+            return json.dumps(self.calendar)
+        if "calendarFeed/url" in path:
+            return BB + "/webapps/calendar/calendarFeed/feed.ics"
+        return "<html></html>"
+
+
+class FakeAdapter(BaseAdapter):
+    def __init__(self, site: Site):
+        super().__init__()
+        self.site = site
+        self.lock = threading.Lock()
+        # Page type (notify.PAGE_TYPES) -> number of requests
+        self.requests = Counter()
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+        with self.lock:
+            self.requests[notify.page_type(request.url)] += 1
+        failure = self.site.failures.get(query.get("content_id"))
+        if isinstance(failure, Exception):
+            raise failure
+        r = Response()
+        r.status_code = failure or 200
+        r.url = request.url
+        r.request = request
+        if failure:
+            r._content = b"<html><body>Internal Server Error</body></html>"
+        else:
+            r._content = self.site.page(url.path, query).encode()
+        r.encoding = "utf-8"
+        r.headers["Content-Type"] = "text/html"
+        return r
+
+    def close(self):
+        pass
+
+
+class FakeLogin(notify.Login):
+    def __init__(self, site: Site):
+        self.adapter = FakeAdapter(site)
+        transport = notify.Transport(limiter=notify.RateLimiter(rate=1000, burst=1000))
+        # Failures are part of the test, not something to wait out
+        transport.max_retries = 0
+        super().__init__("user", "password", transport)
+
+    def login(self, username, password) -> requests.Session:
+        _session = self.transport.mount(requests.Session())
+        _session.mount(BB, self.adapter)
+        return _session
+
+    def is_session_valid(self, _session) -> bool:
+        return True
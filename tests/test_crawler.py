@@ -0,0 +1,65 @@
+import pytest
+import requests
+
+import notify
+from fake_blackboard import Site
+
+
+@pytest.fixture
+def site():
+    return Site(courses=2, roots=2, depth=3, fan=2)
+
+
+def sub_folder(site):
+    """
+    A folder below a root folder, with folders of its own
+    """
+    (root, _), *_ = site.modules[next(iter(site.courses))]
+    return next(_id for _type, _id, _ in site.folders[root] if _type == "folder")
+
+
+def root_folders(login):
+    for retriever in (notify.CourseRetriever, notify.ContentRetriever):
+        retriever.init(login)
+    courses = notify.CourseRetriever.get_course_list(refresh=True)
+    return notify.ContentRetriever.get_root_content_list_by_course(courses)
+
+
+def crawled(contents) -> list[tuple]:
+    return sorted(
+        (content.__class__.__name__, content.id, content.path, content.parent_id)
+        for content in contents
+    )
+
+
+@pytest.mark.parametrize("failing", [False, True], ids=["healthy", "failing"])
+def test_crawler_matches_sequential_traversal(login, site, open_database, failing):
+    if failing:
+        site.failures[sub_folder(site)] = 500
+    sequential = [
+        content for root in root_folders(login) for content in root.get_all_contents()
+    ]
+    items = sum(
+        _type != "folder"
+        for course in site.courses
+        for _type, _, _ in site.items(course)
+    )
+    if failing:
+        # The failing folder is read as empty, its subtree is missing
+        assert len(sequential) < items
+    else:
+        assert len(sequential) == items
+
+    # The same site crawled into an empty database
+    open_database("crawler")
+    contents = notify.ContentCrawler(max_workers=4).crawl(root_folders(login))
+    assert crawled(contents) == crawled(sequential)
+
+
+def test_crawler_raises_fetch_error(login, site):
+    site.failures[sub_folder(site)] = requests.ConnectionError("connection reset")
+    with pytest.raises(requests.ConnectionError):
+        for root in root_folders(login):
+            root.get_all_contents()
+    with pytest.raises(requests.ConnectionError):
+        notify.ContentCrawler(max_workers=4).crawl(root_folders(login))
@@ -0,0 +1,49 @@
+import notify
+
+
+def test_course_tab_within_ttl(login):
+    notify.run_cycle(login)
+    notify.run_cycle(login)
+    assert login.adapter.requests["course_tab"] == 1
+
+    # The daemon's courses interval refreshes it regardless
+    notify.run_cycle(login, ("courses",), refresh_courses=True)
+    assert login.adapter.requests["course_tab"] == 2
+
+
+def test_late_released_announcement(login, site, emails):
+    notify.run_cycle(login)
+    # Written before the others, shown once its "display after" date passed
+    site.announcements["_10001_1"].insert(0, ("_400000_1", "Exam room", "Room 101"))
+    notify.run_cycle(login, ("announcements",))
+    assert [
+        announcement.id for name, announcement in emails if name == "new_announcements"
+    ] == ["_400000_1"]
+
+
+def test_one_commit_per_unit_of_work(login, site, db):
+    for _ in range(4):
+        site.add_course()
+    for _ in range(2):
+        for announcements in site.announcements.values():
+            announcements.insert(0, (site.new_id(), "Reminder", "Bring a pen"))
+        notify.run_cycle(login)
+        # Courses, announcements and contents, however many courses there are
+        assert db.commit_count == 3
+
+
+def test_only_polled_sources_are_compared(login, db, monkeypatch):
+    notify.run_cycle(login)
+    read = []
+    fingerprints = db.fingerprints
+
+    def record(event_type):
+        read.append(event_type)
+        return fingerprints(event_type)
+
+    monkeypatch.setattr(db, "fingerprints", record)
+    notify.run_cycle(login, ("announcements",))
+    assert read == ["CourseEvent", "AnnouncementEvent"]
+    read.clear()
+    notify.run_cycle(login, ("assignments",))
+    assert read == ["CourseEvent", "AssignmentEvent"]
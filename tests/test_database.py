@@ -0,0 +1,118 @@
+import sqlite3
+import threading
+
+import pytest
+
+import notify
+
+
+def test_missing_reference(db):
+    course = notify.CourseEvent("_10001_1", "ABC1001:Course", None)
+    notify.ContentEvent(course, "_400002_1", "Outline", "ABC1001:Course/Outline")
+    # Left behind by older versions, which deleted the course row only
+    db.delete_event("CourseEvent", course.id)
+
+    (content,) = notify.ContentEvent.all()
+    assert isinstance(content.course, notify.MissingEvent)
+    assert content.course.id == "_10001_1"
+    assert str(content.course) == "_10001_1 (removed)"
+
+    # Saving keeps the reference to the course, not to the placeholder
+    content.save()
+    notify.CourseEvent("_10001_1", "ABC1001:Course", None)
+    (content,) = notify.ContentEvent.all()
+    assert isinstance(content.course, notify.CourseEvent)
+
+
+def test_delete_and_add_again_in_unit_of_work(db):
+    course = notify.CourseEvent("_10001_1", "ABC1001:Course", None)
+    with db.unit_of_work():
+        course.delete_self()
+        course.save()
+    assert [event.id for event in notify.CourseEvent.all()] == ["_10001_1"]
+
+    with db.unit_of_work():
+        course.save()
+        course.delete_self()
+    assert notify.CourseEvent.all() == []
+
+
+def test_state_in_unit_of_work(db):
+    db.set_state("key", 1)
+    with db.unit_of_work():
+        db.set_state("key", 2)
+        assert db.get_state("key") == 2
+    assert db.get_state("key") == 2
+
+
+def test_failed_flush(db):
+    with pytest.raises(sqlite3.OperationalError):
+        with db.unit_of_work():
+            notify.CourseEvent("_10001_1", "ABC1001:Course", None)
+            db.set_state("key", 1)
+            db.execute_write("INSERT INTO missing (value) VALUES (?)", (1,))
+    assert db.dirty is None
+    assert db.get_state("key") is None
+    assert notify.CourseEvent.all() == []
+
+    # Saves after the failure are written right away again
+    notify.CourseEvent("_10001_1", "ABC1001:Course", None)
+    assert len(notify.CourseEvent.all()) == 1
+
+
+def test_prune_connections(db):
+    db.conn
+    opened = threading.Barrier(5)
+    done = threading.Event()
+
+    def read():
+        db.get_state("key")
+        opened.wait()
+        done.wait()
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    opened.wait()
+    assert len(db.connections.connections) == 5
+    done.set()
+    for thread in threads:
+        thread.join()
+
+    db.connections.prune()
+    assert list(db.connections.connections) == [threading.current_thread()]
+    assert db.get_state("key") is None
+
+
+def test_delete_course(db):
+    course = notify.CourseEvent("_10001_1", "ABC1001:Course", None)
+    other = notify.CourseEvent("_10002_1", "XYZ2002:Course", None)
+    notify.ContentEvent(course, "_400002_1", "Outline", "ABC1001:Course/Outline")
+    notify.ContentEvent(other, "_400012_1", "Outline", "XYZ2002:Course/Outline")
+    with db.unit_of_work():
+        notify.AnnouncementEvent(course, "_500001_1", "Welcome")
+        course.delete_self()
+
+    assert [event.id for event in notify.CourseEvent.all()] == ["_10002_1"]
+    assert [event.id for event in notify.ContentEvent.all()] == ["_400012_1"]
+    assert notify.AnnouncementEvent.all() == []
+
+
+def test_reads_in_unit_of_work(db):
+    course = notify.CourseEvent("_10001_1", "ABC1001:Course", None)
+    other = notify.CourseEvent("_10002_1", "XYZ2002:Course", None)
+    notify.ContentEvent(course, "_400002_1", "Outline", "ABC1001:Course/Outline")
+    notify.ContentEvent(other, "_400012_1", "Outline", "XYZ2002:Course/Outline")
+    commits = db.commit_count
+    with db.unit_of_work():
+        notify.ContentEvent(course, "_400003_1", "Reading", "ABC1001:Course/Reading")
+        db.delete_event("ContentEvent", "_400002_1")
+        (content,) = notify.ContentEvent.filter(course_id="_10001_1")
+        assert content.id == "_400003_1"
+
+        other.delete_self()
+        assert notify.ContentEvent.filter(course_id="_10002_1") == []
+        assert set(db.fingerprints("ContentEvent")) == {"_400003_1"}
+        assert db.commit_count == commits
+    assert db.commit_count == commits + 1
+    assert [event.id for event in notify.ContentEvent.all()] == ["_400003_1"]
@@ -0,0 +1,92 @@
+import pytest
+
+import notify
+
+
+def ids(changeset: notify.Changeset) -> dict[str, set[str]]:
+    return {
+        kind: {event.id for event in changeset.events(kind)}
+        for kind in ("new", "modified", "removed")
+    }
+
+
+@pytest.fixture
+def changes(monkeypatch):
+    """
+    The changesets of the last cycle, by source
+    """
+    changesets = {}
+
+    def record(contents, assignments, announcements, courses):
+        changesets.update(
+            contents=ids(contents),
+            assignments=ids(assignments),
+            announcements=ids(announcements),
+            courses=ids(courses),
+        )
+
+    monkeypatch.setattr(notify, "print_compare_data", record)
+    # Crawl every course in every cycle
+    monkeypatch.setattr(notify.COURSE_SCHEDULE, "is_due", lambda *args: True)
+    return changesets
+
+
+def test_diff_engine(db):
+    notify.CourseEvent("_10001_1", "ABC1001:Course", None)
+    notify.CourseEvent("_10002_1", "XYZ2002:Course", None)
+    engine = notify.DiffEngine.from_database("CourseEvent")
+    assert len(engine) == 2
+
+    renamed = notify.CourseEvent("_10001_1", "ABC1001:Course (Renamed)", None)
+    assert engine.feed(renamed) == "modified"
+    assert engine.feed(renamed) is None
+    assert engine.feed(notify.CourseEvent("_10003_1", "DEF3003:Course", None)) == "new"
+    changeset = engine.result()
+    assert ids(changeset) == {
+        "new": {"_10003_1"},
+        "modified": {"_10001_1"},
+        "removed": {"_10002_1"},
+    }
+    # Removed events are loaded from the database
+    assert changeset.removed[0].title == "XYZ2002:Course"
+
+
+def test_changeset_of_a_cycle(login, site, changes):
+    notify.run_cycle(login)
+    assert changes["courses"]["new"] == set(site.courses)
+
+    kept, dropped = site.courses
+    (root, _), *_ = site.modules[kept]
+    # A document added, one renamed and a file removed in the kept course
+    folder = site.folders[root]
+    added = site.new_id()
+    folder.append(("document", added, "Syllabus"))
+    index, (_, renamed, title) = next(
+        (index, item) for index, item in enumerate(folder) if item[0] == "document"
+    )
+    folder[index] = ("document", renamed, title + " (updated)")
+    removed = next(item for item in folder if item[0] == "file")
+    folder.remove(removed)
+    dropped_items = site.items(dropped)
+    del site.courses[dropped]
+
+    notify.run_cycle(login, refresh_courses=True)
+    assert changes["courses"] == {"new": set(), "modified": set(), "removed": {dropped}}
+    # Everything of the dropped course is removed with it
+    assert changes["contents"] == {
+        "new": {added},
+        "modified": {renamed},
+        "removed": {removed[1]}
+        | {_id for _type, _id, _ in dropped_items if _type in ("document", "file")},
+    }
+    assert changes["assignments"] == {
+        "new": set(),
+        "modified": set(),
+        "removed": {_id for _type, _id, _ in dropped_items if _type == "assignment"},
+    }
+    assert changes["announcements"]["removed"] == {
+        _id for _id, _, _ in site.announcements[dropped]
+    }
+    assert not changes["announcements"]["new"] | changes["announcements"]["modified"]
+    assert [course.id for course in notify.CourseEvent.all()] == [kept]
+    assert {event.course.id for event in notify.ContentEvent.all()} == {kept}
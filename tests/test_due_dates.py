@@ -0,0 +1,43 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+import pytz
+
+import notify
+
+TZ = pytz.timezone("Asia/Shanghai")
+
+
+@pytest.fixture
+def resolver(login, site):
+    path = os.path.join(notify.TEST_FIXTURE_DIR, "calendar", "selected_events.json")
+    with open(path, encoding="utf-8") as f:
+        site.calendar = json.load(f)
+    notify.CalendarRetriever.init(login)
+    return notify.DueDateResolver()
+
+
+def test_due_dates_by_course_and_title(resolver):
+    assert resolver.get("_10001_1", "Homework 1") == TZ.localize(
+        datetime(2030, 3, 10, 23, 59)
+    )
+    assert resolver.get("_10002_1", "Homework 1") == TZ.localize(
+        datetime(2030, 3, 12, 18, 0)
+    )
+    assert resolver.get("_10001_1", "Project Proposal ") == TZ.localize(
+        datetime(2030, 3, 17, 12, 0)
+    )
+    assert resolver.hits == 3
+
+
+def test_events_that_are_no_due_dates(resolver):
+    # itemSourceId is the gradebook column, not the content id
+    assert resolver.get("_10001_1", "_90001_1") is None
+    # Two columns share the title, the newAttempt page has to tell
+    assert resolver.get("_10002_1", "Quiz") is None
+    # A course calendar entry and a personal event
+    assert resolver.get("_10001_1", "Midterm Review") is None
+    assert resolver.get("PERSONAL", "Homework 1") is None
+    assert resolver.hits == 0
@@ -0,0 +1,203 @@
+"""
+The precompiled extractors must return what the original per-page parsers did.
+The reference parsers below are the original ones, with the event constructors
+replaced by tuples.
+"""
+
+import os
+
+import pytest
+from lxml import etree
+
+import notify
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def fixtures(page_type):
+    page_dir = os.path.join(FIXTURE_DIR, page_type)
+    return [
+        pytest.param(os.path.join(page_dir, name), id=name)
+        for name in sorted(os.listdir(page_dir))
+    ]
+
+
+def read(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def reference_courses(data):
+    courses = []
+    for line in data.split("\n"):
+        if "type=Course" in line:
+            course_id = line.split("id=")[1].split("&")[0]
+            course_name = line.split(">")[1].split("<")[0]
+            courses.append((course_id, course_name))
+    return courses
+
+
+def reference_modules(data):
+    root_contents = []
+    html = etree.HTML(data)
+    for element in html.xpath("//li"):
+        href = element.xpath("a")
+        if len(href) <= 0:
+            continue
+        href_str = href[0].get("href")
+        if href and "content_id" in href_str:
+            content_id = href_str.split("content_id=")[1].split("&")[0]
+            title = href[0].xpath("span/text()")[0]
+            root_contents.append((content_id, title))
+    return root_contents
+
+
+def reference_content_items(data):
+    """
+    :return: (content_id, kind, title, detail), kind is the event class the
+        original parser created
+    """
+    items = []
+    _html = etree.HTML(data)
+    if len(_html.xpath('//*[@id="content_listContainer"]')) <= 0:
+        return items
+    for _li in _html.xpath('//*[@id="content_listContainer"]')[0]:
+        _content_id = _li.xpath("@id")[0].split(":")[1]
+        _type = _li.xpath("img/@src")[0].split("/")[-1].split("_")[0]
+        div = _li.xpath("div[1]")
+        if _type == "folder":
+            items.append(
+                (_content_id, "folder", div[0].xpath("h3/a/span/text()")[0], None)
+            )
+        elif _type == "document":
+            _title = div[0].xpath("h3/span[2]/text()")[0]
+            try:
+                _detail = _li.xpath("div[2]/div[2]/div/span/text()")[0]
+            except IndexError:
+                _detail = ""
+            items.append((_content_id, "content", _title, _detail))
+        elif _type == "assignment":
+            items.append(
+                (_content_id, "assignment", div[0].xpath("h3/a/span/text()")[0], None)
+            )
+        elif _type == "file":
+            items.append(
+                (_content_id, "file", div[0].xpath("h3/a/span/text()")[0], None)
+            )
+        elif _type == "image":
+            items.append(
+                (_content_id, "file", div[0].xpath("h3/span[2]/text()")[0], None)
+            )
+        elif _type == "panopto":
+            _title = (
+                div[0].xpath("h3/a/span/text()")[0]
+                if div[0].xpath("h3/a/span/text()")
+                else div[0].xpath("h3/span/text()")[0]
+            )
+            items.append((_content_id, "content", _title, "Panopto Video"))
+        elif _type == "discussion":
+            _title = div[0].xpath("h3/a/span/text()")[0]
+            items.append((_content_id, "content", _title, "Discussion"))
+        else:
+            try:
+                _title = div[0].xpath("h3/a/span/text()")[0]
+            except IndexError:
+                _title = div[0].xpath("h3/span[2]/text()")[0]
+            items.append((_content_id, "content", _title, _type))
+    return items
+
+
+def reference_announcements(data):
+    announcements = []
+    html = etree.HTML(data)
+    ul_list = html.xpath('//*[@id="announcementList"]')
+    if len(ul_list) <= 0:
+        return []
+    for element in ul_list[0].xpath("//li"):
+        _id = element.xpath("@id")
+        if _id and _id[0].startswith("_"):
+            title = element.xpath("h3/text()")[0]
+            raw_detail = element.xpath("string(.)").strip().split("\n")
+            raw_detail = [x.strip() for x in raw_detail if x.strip()]
+            announcements.append((_id[0], title, "\n".join(raw_detail[1:])))
+    return announcements
+
+
+def reference_assignment_detail(data):
+    r2 = etree.HTML(data)
+    due_date = r2.xpath('//*[@id="metadata"]/div/div/div[1]/div[2]/text()')[0].strip()
+    due_time = r2.xpath('//*[@id="metadata"]/div/div/div[1]/div[2]/span/text()')[
+        0
+    ].strip()
+    detail = r2.xpath('//*[@id="instructions"]')[0].xpath("string(.)").strip()
+    return due_date, due_time, detail
+
+
+def content_kind(_type):
+    """
+    Event class ContentListEvent.add_items creates for a content type
+    """
+    if _type == "folder":
+        return "folder"
+    if _type == "assignment":
+        return "assignment"
+    if _type in ("file", "image"):
+        return "file"
+    return "content"
+
+
+@pytest.mark.parametrize("path", fixtures("course_tab"))
+def test_courses(path):
+    data = read(path)
+    assert notify.extract_courses(data) == reference_courses(data)
+
+
+@pytest.mark.parametrize("path", fixtures("module_page"))
+def test_modules(path):
+    data = read(path)
+    modules = notify.extract_modules(data)
+    assert modules == reference_modules(data)
+
+
+@pytest.mark.parametrize("path", fixtures("list_content"))
+def test_content_items(path):
+    data = read(path)
+    items = [
+        (_id, content_kind(_type), title, detail)
+        for _id, _type, title, detail in notify.extract_content_items(data)
+    ]
+    assert items == reference_content_items(data)
+
+
+@pytest.mark.parametrize("path", fixtures("announcement"))
+def test_announcements(path):
+    data = read(path)
+    assert notify.extract_announcements(data) == reference_announcements(data)
+
+
+@pytest.mark.parametrize("path", fixtures("announcement"))
+def test_announcements_known(path):
+    data = read(path)
+    announcements = reference_announcements(data)
+    known = {_id for _id, _, _ in announcements}
+    assert notify.extract_announcements(data, known=known) == []
+    # Skipped by id, not by position or id order
+    known.remove(announcements[1][0])
+    assert notify.extract_announcements(data, known=known) == [announcements[1]]
+
+
+@pytest.mark.parametrize("path", fixtures("new_attempt"))
+def test_assignment_detail(path):
+    data = read(path)
+    assert notify.extract_assignment_detail(data) == reference_assignment_detail(data)
+
+
+@pytest.mark.parametrize("path", fixtures("upload_assignment"))
+def test_submission_status(path):
+    data = read(path)
+    assert notify.extract_submission_status(data) == ("Review Submission" in data)
+
+
+def test_every_page_type_has_fixtures():
+    for page_type in notify.EXTRACTORS:
+        assert fixtures(page_type), page_type
@@ -0,0 +1,231 @@
+"""
+Databases written by the original `python notify.py` hold whole object graphs
+pickled under __main__. They have to migrate whether notify is imported by the
+daemon or started as a script.
+"""
+
+import os
+import pickle
+import runpy
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime
+
+import pytest
+
+import notify
+
+NOTIFY_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "notify.py")
+
+# The event classes and table of the original notify.py, run as a script so the
+# rows are pickled under __main__
+LEGACY_SCRIPT = '''
+import pickle
+import sqlite3
+from datetime import datetime
+
+from requests import Session
+
+
+class Login:
+    def __init__(self, username, password):
+        self._session = Session()
+
+
+class BBLogin(Login):
+    pass
+
+
+class BaseEvent:
+    def __init__(self, title, _id, _login):
+        self.title = title
+        self.id = _id
+        self.login = _login
+        self.save()
+
+    def save(self):
+        conn.execute(
+            "INSERT OR REPLACE INTO events (obj, id_str, event_type) VALUES (?, ?, ?)",
+            (pickle.dumps(self), self.id, self.__class__.__name__),
+        )
+        conn.commit()
+
+
+class CourseEvent(BaseEvent):
+    def __init__(self, course_id, course_name, _login):
+        self.root_content_list = []
+        super().__init__(title=course_name, _id=course_id, _login=_login)
+
+
+class ContentEvent(BaseEvent):
+    metadata = {}
+
+    def __init__(self, _course, content_id, content_name, path, detail="", metadata=None):
+        if metadata is None:
+            metadata = {"detail": detail}
+        self.course = _course
+        self.path = path
+        self.detail = detail
+        self.metadata.update(metadata)
+        super().__init__(title=content_name, _id=content_id, _login=_course.login)
+
+
+class AssignmentEvent(ContentEvent):
+    def __init__(self, _course, assignment_id, assignment_name, path):
+        super().__init__(_course, assignment_id, assignment_name, path, metadata={})
+        self.metadata = {
+            "is_finished": False,
+            "due": datetime(2030, 3, 10, 23, 59),
+            "detail": "Answer all questions",
+        }
+        self.save()
+
+
+class FileEvent(ContentEvent):
+    pass
+
+
+class ContentListEvent(ContentEvent):
+    def __init__(self, _course, content_id, content_name, path):
+        self.contents_num = 0
+        self.contents = []
+        super().__init__(_course, content_id, content_name, path)
+        self.course.root_content_list.append(self)
+        self.course.save()
+
+    def add_content(self, content):
+        self.contents.append(content)
+        self.contents_num += 1
+        self.save()
+
+
+class AnnouncementEvent(BaseEvent):
+    def __init__(self, _course, announcement_id, announcement_name, metadata=None):
+        self.course = _course
+        self.metadata = metadata or {}
+        super().__init__(title=announcement_name, _id=announcement_id, _login=_course.login)
+
+
+conn = sqlite3.connect("events.db")
+conn.execute(
+    """CREATE TABLE IF NOT EXISTS events
+                       (id TEXT, obj BLOB, id_str TEXT, event_type TEXT,
+                       PRIMARY KEY (id_str, event_type))"""
+)
+login = BBLogin("user", "password")
+course = CourseEvent("_10001_1", "ABC1001:Introduction_to_Examples_L01", login)
+week = ContentListEvent(course, "_300001_1", "Week 1", course.title + "/Week 1")
+week.add_content(AssignmentEvent(course, "_400004_1", "Homework 1", week.path + "/Homework 1"))
+week.add_content(ContentEvent(course, "_400002_1", "Outline", week.path + "/Outline", "Read it"))
+week.add_content(FileEvent(course, "_400005_1", "Lecture 1.pdf", week.path + "/Lecture 1.pdf"))
+AnnouncementEvent(course, "_500001_1", "Welcome", {"detail": "Welcome to the course."})
+'''
+
+
+@pytest.fixture
+def legacy_db(db):
+    # The database is opened on first use, after the script wrote it
+    persist_dir = os.path.dirname(db.db_name)
+    os.makedirs(persist_dir)
+    subprocess.run(
+        [sys.executable, "-c", LEGACY_SCRIPT], cwd=persist_dir, check=True, timeout=60
+    )
+    return db
+
+
+def check_migrated(db):
+    (assignment,) = notify.AssignmentEvent.all()
+    assert isinstance(assignment, notify.AssignmentEvent)
+    assert assignment.parent_id == "_300001_1"
+    assert assignment.metadata["due"] == datetime(2030, 3, 10, 23, 59)
+    assert isinstance(assignment.course, notify.CourseEvent)
+    assert assignment.course.title == "ABC1001:Introduction_to_Examples_L01"
+    # The root folders are the rows without a parent, not a list on the course
+    assert "root_content_list" not in assignment.course.__dict__
+    (folder,) = notify.ContentListEvent.all()
+    assert {type(child) for child in folder.contents} == {
+        notify.AssignmentEvent,
+        notify.ContentEvent,
+        notify.FileEvent,
+    }
+    (announcement,) = notify.AnnouncementEvent.all()
+    assert announcement.get_detail() == "Welcome to the course."
+
+    conn = sqlite3.connect(db.db_name)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == db.schema_version
+    rows = {
+        (event_type, id_str): (course_id, parent_id, obj)
+        for event_type, id_str, course_id, parent_id, obj in conn.execute(
+            "SELECT event_type, id_str, course_id, parent_id, obj FROM events"
+        )
+    }
+    conn.close()
+    assert len(rows) == 6
+    for (event_type, _), (course_id, _, obj) in rows.items():
+        assert b"__main__" not in obj
+        assert b"root_content_list" not in obj
+        if event_type != "CourseEvent":
+            assert course_id == "_10001_1"
+    for child in ("_400004_1", "_400002_1", "_400005_1"):
+        assert any(
+            key[1] == child and value[1] == "_300001_1" for key, value in rows.items()
+        )
+
+
+def test_migrate_imported(legacy_db):
+    """
+    The daemon imports notify
+    """
+    check_migrated(legacy_db)
+
+
+def test_migrate_as_script(legacy_db, monkeypatch):
+    """
+    `python notify.py` runs the notify module instead of its __main__ copy
+    """
+    ran = []
+
+    def main():
+        check_migrated(legacy_db)
+        ran.append(True)
+
+    monkeypatch.setattr(notify, "main", main)
+    runpy.run_path(NOTIFY_PATH, run_name="__main__")
+    assert ran
+
+
+def test_load_main_pickle(legacy_db):
+    """
+    Rows the current code wrote as a script before it ran as the notify module
+    """
+    check_migrated(legacy_db)
+    event = notify.AssignmentEvent.all()[0]
+    data = pickle.dumps(event).replace(b"cnotify\n", b"c__main__\n")
+    data = data.replace(b"\x8c\x06notify", b"\x8c\x08__main__")
+    assert b"notify" not in data
+    loaded = notify.load_event(data)
+    assert isinstance(loaded, notify.AssignmentEvent)
+    assert loaded.__dict__ == event.__dict__
+
+
+def test_reopen_migrated(legacy_db):
+    """
+    A migrated database is opened as it is
+    """
+    check_migrated(legacy_db)
+    legacy_db.close()
+    db = notify.Database(legacy_db.db_name)
+    db.conn
+    assert not db.pending_backfill
+    tables = {
+        name
+        for (name,) in db.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    }
+    assert tables == {"events", "state", "pages"}
+    columns = [row[1] for row in db.conn.execute("PRAGMA table_info(events)")]
+    assert set(db.columns) <= set(columns)
+    assert db.conn.execute("SELECT COUNT(*) FROM events").fetchone()[0] == 6
+    db.close()
@@ -0,0 +1,42 @@
+import smtplib
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import notify
+
+DUE = datetime(2030, 3, 10, 23, 59, tzinfo=pytz.timezone("Asia/Shanghai"))
+
+
+@pytest.fixture
+def timers(db, monkeypatch):
+    def get_detail(self, cached=None):
+        self.metadata = {"is_finished": False, "due": DUE, "detail": ""}
+
+    monkeypatch.setattr(notify.AssignmentEvent, "_get_detail", get_detail)
+    course = notify.CourseEvent("_10001_1", "ABC1001:Course", None)
+    notify.AssignmentEvent(course, "_400004_1", "Homework 1", "ABC1001:Course/HW")
+    return notify.DeadlineTimers([timedelta(hours=2), timedelta(minutes=30)])
+
+
+def test_failed_reminder_is_retried(timers, monkeypatch):
+    sent = []
+
+    def notify_email(name, assignment):
+        if not sent:
+            sent.append(None)
+            raise smtplib.SMTPException("connection lost")
+        sent.append(assignment.id)
+
+    monkeypatch.setattr(notify, "notify_email", notify_email)
+    now = DUE.timestamp() - 3600
+    assert timers.fire(now) == []
+    assert timers._sent() == {}
+    assert timers.next_fire() == now + timers.retry_delay
+
+    (reminded,) = timers.fire(now + timers.retry_delay)
+    assert reminded.id == "_400004_1"
+    assert sent == [None, "_400004_1"]
+    assert timers._sent() == {"_400004_1": [DUE.timestamp(), [7200.0]]}
+    assert timers.next_fire() == DUE.timestamp() - 1800
@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+import pytest
+
+import notify
+
+
+@pytest.fixture
+def schedule(db):
+    return notify.PollSchedule(
+        "course",
+        minimum=timedelta(minutes=10),
+        maximum=timedelta(minutes=30),
+        initial=timedelta(minutes=30),
+    )
+
+
+def test_quiet_course_is_polled_at_the_maximum(schedule):
+    start = 1_000_000.0
+    schedule.record("_10001_1", "a", polled_at=start)
+    for poll in range(1, 10):
+        polled_at = start + poll * 30 * 60
+        assert schedule.is_due("_10001_1", now=polled_at)
+        schedule.record("_10001_1", "a", polled_at=polled_at)
+    assert not schedule.is_due("_10001_1", now=polled_at + 20 * 60)
+
+
+def test_changes_shorten_the_interval(schedule):
+    schedule.record("_10001_1", "a", polled_at=0)
+    assert schedule.record("_10001_1", "b", polled_at=30 * 60)
+    assert schedule.is_due("_10001_1", now=45 * 60)
+    assert schedule.is_due("_10001_1", boost=True, now=50 * 60)
+
+
+def test_stored_interval_above_the_maximum(schedule):
+    notify.BaseEvent.db.set_state(
+        "poll:course:_10001_1",
+        {
+            "interval": 24 * 3600,
+            "digest": "a",
+            "polls": 5,
+            "changes": 0,
+            "changed_at": None,
+            "polled_at": 0,
+        },
+    )
+    assert schedule.is_due("_10001_1", now=30 * 60)